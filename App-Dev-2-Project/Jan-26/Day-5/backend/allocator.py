@@ -0,0 +1,326 @@
+import bisect
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from flask import current_app
+from models import db, ParkingSpot, Reservation
+
+DAY = timedelta(days=1)
+SLOT_MINUTES = 15
+WORDS = 2  # 96 quarter-hour slots a day, as two 64-bit words per spot
+
+
+def days(start, end):
+    # ordinals of the days the window [start, end) touches
+    return range(start.toordinal(), (end - timedelta(microseconds=1)).toordinal() + 1)
+
+
+def slot_mask(day, start, end):
+    # bit s is set when [start, end) touches quarter-hour s of day (an ordinal)
+    midnight = datetime.fromordinal(day)
+    first = (max(start, midnight) - midnight).total_seconds() / 60 / SLOT_MINUTES
+    last = (min(end, midnight + DAY) - midnight).total_seconds() / 60 / SLOT_MINUTES
+    return ((1 << math.ceil(last)) - 1) ^ ((1 << math.floor(first)) - 1)
+
+
+def words(mask):
+    return [(mask >> (64 * k)) & (2 ** 64 - 1) for k in range(WORDS)]
+
+
+def is_free(windows, start, end):
+    # the last window starting before end is the only one that can reach past start
+    starts, ends = windows
+    i = bisect.bisect_left(starts, end)
+    return i == 0 or ends[i - 1] <= start
+
+
+class LotCalendar:
+    # One lot's spots, spot_id -> (starts, ends), with its own lock. by_day[day ordinal] holds one mask per spot of
+    # the quarter hours its windows touch that day, so one vectorized pass finds the spots whose slots are all clear
+    # for a request: those are free without looking at their windows. Only spots sharing a quarter hour with the
+    # request (say booked until 10:20 when 10:20-12:00 is asked for) need the bisect. Spots are kept in id order.
+    # held is the windows booked here whose reservation has not been committed yet; while a reload reads the
+    # database, journal lists every insert and delete so replace() can apply them on top of what was read.
+
+    def __init__(self, spots):
+        self.lock = threading.Lock()
+        self.held = set()
+        self.journal = None
+        self.spots = spots
+        self.ids = sorted(spots)
+        self.index = {spot_id: i for i, spot_id in enumerate(self.ids)}
+        self.by_day = {}
+        for spot_id, (starts, ends) in spots.items():
+            for start, end in zip(starts, ends):
+                self.mark(spot_id, start, end)
+
+    def mark(self, spot_id, start, end):
+        i = self.index[spot_id]
+        for day in days(start, end):
+            if day not in self.by_day:
+                self.by_day[day] = [np.zeros(len(self.ids), dtype=np.uint64) for k in range(WORDS)]
+            for masks, word in zip(self.by_day[day], words(slot_mask(day, start, end))):
+                masks[i] |= np.uint64(word)
+
+    def unmark(self, spot_id, start, end):
+        # rebuild the spot's masks for the window's days from the windows it still has
+        i = self.index[spot_id]
+        starts, ends = self.spots[spot_id]
+        for day in days(start, end):
+            midnight = datetime.fromordinal(day)
+            mask = 0
+            j = bisect.bisect_left(starts, midnight + DAY)
+            while j > 0 and ends[j - 1] > midnight:
+                j -= 1
+                mask |= slot_mask(day, starts[j], ends[j])
+            for masks, word in zip(self.by_day[day], words(mask)):
+                masks[i] = word
+
+    def add_spot(self, spot_id):
+        # a spot this calendar was not loaded with (a lot created after the last load)
+        self.spots[spot_id] = ([], [])
+        self.index[spot_id] = len(self.ids)
+        self.ids.append(spot_id)
+        for day, masks in self.by_day.items():
+            self.by_day[day] = [np.append(word_masks, np.uint64(0)) for word_masks in masks]
+
+    def sharing_slots(self, start, end):
+        # True for every spot with a window in one of the quarter hours [start, end) touches
+        shared = np.zeros(len(self.ids), dtype=bool)
+        for day in days(start, end):
+            for masks, word in zip(self.by_day.get(day, ()), words(slot_mask(day, start, end))):
+                if word:
+                    shared |= (masks & np.uint64(word)) != 0
+        return shared
+
+    def is_spot_free(self, spot_id, start, end):
+        return spot_id not in self.spots or is_free(self.spots[spot_id], start, end)
+
+    def start_journal(self):
+        # a held window was booked before the database is read but may be committed after it, so it goes in first
+        self.journal = [('insert', window) for window in self.held]
+
+    def replace(self, fresh):
+        # take over the windows of fresh (read from the database) in place, so callers that already hold this
+        # lot keep booking into the live calendar, after replaying what was booked and released during the read.
+        # Returns the ids of the spots whose windows this changed: the calendar had drifted from the database there
+        for op, window in self.journal or ():
+            if op == 'delete':
+                fresh.delete(*window)
+            elif fresh.is_spot_free(*window):
+                fresh.insert(*window)
+        changed = {spot_id for spot_id in set(self.spots) | set(fresh.spots) if self.spots.get(spot_id) != fresh.spots.get(spot_id)}
+        self.spots, self.ids, self.index, self.by_day = fresh.spots, fresh.ids, fresh.index, fresh.by_day
+        self.journal = None
+        return changed
+
+    def insert(self, spot_id, start, end):
+        if self.journal is not None:
+            self.journal.append(('insert', (spot_id, start, end)))
+        if spot_id not in self.spots:
+            self.add_spot(spot_id)
+        starts, ends = self.spots[spot_id]
+        i = bisect.bisect_left(starts, start)
+        starts.insert(i, start)
+        ends.insert(i, end)
+        self.mark(spot_id, start, end)
+
+    def delete(self, spot_id, start, end):
+        if self.journal is not None:
+            self.journal.append(('delete', (spot_id, start, end)))
+        windows = self.spots.get(spot_id)
+        if not windows:
+            return
+        starts, ends = windows
+        i = bisect.bisect_left(starts, start)
+        while i < len(starts) and starts[i] == start:
+            if ends[i] == end:
+                del starts[i], ends[i]
+                self.unmark(spot_id, start, end)
+                return
+            i += 1
+
+    def candidates(self, start, end):
+        # spots free for the window, clear ones first, lowest id first. Each is checked against its windows as it
+        # is handed out, so take_many can keep drawing from this after booking earlier ones
+        shared = self.sharing_slots(start, end)
+        for indexes in (np.flatnonzero(~shared), np.flatnonzero(shared)):
+            for i in indexes.tolist():
+                if is_free(self.spots[self.ids[i]], start, end):
+                    yield self.ids[i]
+
+    def free_spots(self, start, end):
+        shared = self.sharing_slots(start, end)
+        free = [i for i in np.flatnonzero(shared).tolist() if is_free(self.spots[self.ids[i]], start, end)]
+        return [self.ids[i] for i in sorted(np.flatnonzero(~shared).tolist() + free)]
+
+
+class SpotCalendar:
+    # parking_lot_id -> LotCalendar, the windows of every spot's active reservations sorted by start.
+    # Windows on one spot never overlap, so the ends are sorted as well and "is this spot free between
+    # start and end" is a single bisect. The database stays the source of truth: bookings are re-checked
+    # by booking.insert_if_free, and the whole calendar is compared with the database every verify_every seconds.
+    # self.lock only guards the lot map; each lot is read and booked under its own lock. One reload runs at a
+    # time under self.refreshing, and bookings carry on while it reads the database.
+
+    def __init__(self, verify_every=300):
+        self.verify_every = verify_every
+        self.lock = threading.Lock()
+        self.refreshing = threading.RLock()
+        self.lots = {}
+        self.journaling = False
+        self.loaded_at = None
+
+    def scan(self, parking_lot_id=None):
+        spots = db.session.query(ParkingSpot.parking_lot_id, ParkingSpot.id)
+        windows = db.session.query(
+            ParkingSpot.parking_lot_id, ParkingSpot.id, Reservation.start_time, Reservation.end_time
+        ).join(ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id).filter(Reservation.status == 'active')
+        if parking_lot_id is not None:
+            spots = spots.filter(ParkingSpot.parking_lot_id == parking_lot_id)
+            windows = windows.filter(ParkingSpot.parking_lot_id == parking_lot_id)
+        lots = {}
+        for lot_id, spot_id in spots.yield_per(10000):
+            lots.setdefault(lot_id, {})[spot_id] = ([], [])
+        for lot_id, spot_id, start, end in windows.order_by(Reservation.start_time).yield_per(10000):
+            starts, ends = lots[lot_id][spot_id]
+            starts.append(start)
+            ends.append(end)
+        return lots
+
+    def load(self, parking_lot_id=None):
+        # re-read one lot, or every lot, from the database. Lots are refreshed in place and journal what is booked
+        # and released while the database is read (lots created meanwhile start journaling too), so nothing is lost.
+        # Returns {parking_lot_id: {spot ids whose windows changed}} like check()
+        with self.refreshing:
+            with self.lock:
+                if parking_lot_id is None:
+                    self.journaling = True
+                    lots = list(self.lots.values())
+                else:
+                    lots = [self.lots.setdefault(parking_lot_id, LotCalendar({}))]
+                for lot in lots:
+                    with lot.lock:
+                        lot.start_journal()
+            fresh = {lot_id: LotCalendar(spots) for lot_id, spots in self.scan(parking_lot_id).items()}
+            with self.lock:
+                if parking_lot_id is None:
+                    self.journaling = False
+                stale = {lot_id: lot for lot_id, lot in self.lots.items() if parking_lot_id in (None, lot_id)}
+                added = {lot_id: lot for lot_id, lot in fresh.items() if lot_id not in stale}
+                self.lots.update(added)
+            diff = {lot_id: set(lot.spots) for lot_id, lot in added.items() if lot.spots}
+            for lot_id, lot in stale.items():
+                with lot.lock:
+                    changed = lot.replace(fresh.get(lot_id, LotCalendar({})))
+                if changed:
+                    diff[lot_id] = changed
+            if parking_lot_id is None:
+                self.loaded_at = time.monotonic()
+            return diff
+
+    def load_lot(self, parking_lot_id):
+        self.load(parking_lot_id)
+
+    def lot(self, parking_lot_id):
+        lot = self.lots.get(parking_lot_id)
+        if lot is None:
+            with self.lock:
+                lot = self.lots.get(parking_lot_id)
+                if lot is None:
+                    lot = self.lots[parking_lot_id] = LotCalendar({})
+                    if self.journaling:
+                        lot.start_journal()
+        return lot
+
+    def check(self):
+        # {parking_lot_id: {spot ids whose windows differ from the database}} for every lot that disagrees.
+        # Bookings in flight count as differences, so this is for a quiet calendar; verify() is exact under load
+        actual = self.scan()
+        with self.lock:
+            lots = dict(self.lots)
+        diff = {}
+        for lot_id in set(actual) | set(lots):
+            in_db = actual.get(lot_id, {})
+            lot = lots.get(lot_id, LotCalendar({}))
+            with lot.lock:
+                indexed = lot.spots
+                spots = {spot_id for spot_id in set(in_db) | set(indexed) if in_db.get(spot_id) != indexed.get(spot_id)}
+            if spots:
+                diff[lot_id] = spots
+        return diff
+
+    def verify(self):
+        # reload everything, and say where the calendar had drifted (writes from other processes, lost releases)
+        diff = self.load()
+        if diff:
+            current_app.logger.warning('spot calendar was out of step with the database for lots %s, reloaded', sorted(diff))
+        return diff
+
+    def refresh_if_due(self):
+        # the first request to find the calendar due verifies it; the rest carry on with the calendar as it is
+        # instead of queueing behind it. Only the very first load is waited for, there is nothing to serve before it
+        if self.loaded_at is None:
+            with self.refreshing:
+                if self.loaded_at is None:
+                    self.load()
+        elif time.monotonic() - self.loaded_at >= self.verify_every and self.refreshing.acquire(blocking=False):
+            try:
+                if time.monotonic() - self.loaded_at >= self.verify_every:
+                    self.verify()
+            finally:
+                self.refreshing.release()
+
+    def free_spots(self, parking_lot_id, start, end):
+        self.refresh_if_due()
+        lot = self.lot(parking_lot_id)
+        with lot.lock:
+            return lot.free_spots(start, end)
+
+    def take(self, parking_lot_id, start, end):
+        # first spot free for the window; it is booked in the calendar straight away so concurrent callers skip it
+        return self.take_many(parking_lot_id, [(start, end)])[0]
+
+    def take_many(self, parking_lot_id, windows):
+        # take() for every (start, end) under the lot's lock; None for a window with no free spot.
+        # Repeats of a window carry on where the last one stopped
+        self.refresh_if_due()
+        lot = self.lot(parking_lot_id)
+        taken = []
+        with lot.lock:
+            candidates = {}
+            for start, end in windows:
+                remaining = candidates.setdefault((start, end), lot.candidates(start, end))
+                spot_id = next(remaining, None)
+                if spot_id is not None:
+                    lot.insert(spot_id, start, end)
+                    lot.held.add((spot_id, start, end))
+                taken.append(spot_id)
+        return taken
+
+    def add(self, parking_lot_id, spot_id, start, end):
+        # books the window unless the calendar already has it taken; returns whether it did
+        lot = self.lot(parking_lot_id)
+        with lot.lock:
+            if not lot.is_spot_free(spot_id, start, end):
+                return False
+            lot.insert(spot_id, start, end)
+            lot.held.add((spot_id, start, end))
+            return True
+
+    def settle(self, parking_lot_id, windows):
+        # the transaction that booked these (spot_id, start, end) windows has committed: a reload reads them now
+        lot = self.lot(parking_lot_id)
+        with lot.lock:
+            lot.held.difference_update(windows)
+
+    def remove(self, parking_lot_id, spot_id, start, end):
+        lot = self.lot(parking_lot_id)
+        with lot.lock:
+            lot.delete(spot_id, start, end)
+            lot.held.discard((spot_id, start, end))
+
+
+spot_calendar = SpotCalendar()
@@ -1,17 +1,40 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from models import db, User, ParkingLot, ParkingSpot, Reservation
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
-from flask_caching import Cache
+from models import db, User, ParkingLot, ParkingSpot, Reservation, create_indexes
+from passwords import hasher, HashingBusy, DEFAULT_HASH_METHOD
+from revocation import revocations
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from provisioning import create_lot_with_spots, import_lots, lot_error
+from allocator import spot_calendar
+from booking import book_spot, book_spots, release_booking, MAX_BATCH_BOOKINGS
+from pagination import keyset_page
+from summary import lot_totals, status_counts, rebuild_lot_stats, rebuild_occupancy, occupancy_series
+from caching import cache, cached_json, invalidate, cached_per_user, reservations_changed, conditional
+from export import EXPORT_FORMATS, EXPORT_CHUNK_ROWS
+from pricing import quote, booking_cost, set_rate_table, MAX_QUOTES, HOURS_PER_DAY
+import numpy as np
+from sqlalchemy import func
+import os
+import re
+from datetime import timedelta
 
 app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///parking.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///parking.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key'
-app.config['CACHE_TYPE'] = 'RedisCache'
+app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=15)
+app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)  # how long a login lasts without the password
+app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'RedisCache')  # SimpleCache keeps entries in process memory
 app.config['CACHE_REDIS_URL'] = 'redis://localhost:6379/0'
+# SimpleCache's inc() rewrites a version key with the default timeout, so the default must be "never";
+# every cached body passes its own timeout (caching.CACHE_TIMEOUT)
+app.config['CACHE_DEFAULT_TIMEOUT'] = 0
+# any werkzeug method, e.g. 'pbkdf2:sha256:600000'; hashes made with another method are upgraded on the next login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD)
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
 
 
 
@@ -21,10 +44,31 @@ db.init_app(app)
 
 jwt = JWTManager(app)
 
-cache = Cache(app)
-
-
-
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    return revocations.is_revoked(jwt_payload['jti'])
+
+cache.init_app(app)
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    response = jsonify({'message': 'Too many logins right now, please try again'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def authenticate(username, password):
+    # the user if the password matches, saving a rehash when the hashing policy has changed since it was set
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        return None
+    matches, new_hash = hasher.verify(user.password, password)
+    if not matches:
+        return None
+    if new_hash:
+        user.password = new_hash
+        db.session.commit()
+    return user
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -36,7 +80,7 @@ def register():
     user = User(
         username=data['username'],
         email=data['email'],        
-        password=generate_password_hash(data['password']),
+        password=hasher.hash(data['password']),
         role='user'
     )
     db.session.add(user)
@@ -47,23 +91,56 @@ def register():
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
-    user = User.query.filter_by(username=data['username']).first()
+    user = authenticate(data['username'], data['password'])
     
-    if user and check_password_hash(user.password, data['password']):
+    if user:
         access_token = create_access_token(identity=user.id, additional_claims={'role': user.role})
-        return jsonify({'message': 'Login successful', 'data': {'username': user.username, 'email': user.email, 'role': user.role, 'access_token': access_token}}), 200
+        refresh_token = create_refresh_token(identity=user.id)
+        return jsonify({'message': 'Login successful', 'data': {'username': user.username, 'email': user.email, 'role': user.role, 'access_token': access_token, 'refresh_token': refresh_token}}), 200
     else:
         return jsonify({'message': 'Invalid username or password'}), 401
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
     data = request.get_json()
-    user = User.query.filter_by(username=data['username']).first()
+    user = authenticate(data['username'], data['password'])
 
-    if user and check_password_hash(user.password, data['password']) and user.role == 'admin':
+    if user and user.role == 'admin':
         access_token = create_access_token(identity=user.id, additional_claims={'role': user.role})
-        return jsonify({'message': 'Admin login successful', 'data': {'username': user.username, 'email': user.email, 'role': user.role, 'access_token': access_token}}), 200
+        refresh_token = create_refresh_token(identity=user.id)
+        return jsonify({'message': 'Admin login successful', 'data': {'username': user.username, 'email': user.email, 'role': user.role, 'access_token': access_token, 'refresh_token': refresh_token}}), 200
     else:
         return jsonify({'message': 'Invalid admin credentials'}), 401
+
+@app.route('/api/logout', methods=['POST'])
+@jwt_required(verify_type=False)
+def logout():
+    # revokes the token it is called with and, if {'refresh_token'} is sent, the refresh token of the same user
+    tokens = [get_jwt()]
+    refresh = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh:
+        try:
+            claims = decode_token(refresh)
+        except (JWTExtendedException, PyJWTError):
+            return jsonify({'message': 'Invalid refresh token'}), 400
+        if claims['sub'] != get_jwt()['sub']:
+            return jsonify({'message': 'Invalid refresh token'}), 400
+        tokens.append(claims)
+
+    for claims in tokens:
+        revocations.revoke(claims['jti'], claims['exp'])
+    return jsonify({'message': 'Logged out successfully'}), 200
+
+@app.route('/api/token/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh_token():
+    # a new access token for the refresh token's user, with no password check; the role is read again
+    # with one primary key lookup so a changed role or a deleted user takes effect on the next refresh
+    user_id = get_jwt_identity()
+    role = db.session.query(User.role).filter(User.id == user_id).scalar()
+    if role is None:
+        return jsonify({'message': 'User not found'}), 401
+    access_token = create_access_token(identity=user_id, additional_claims={'role': role})
+    return jsonify({'access_token': access_token}), 200
 @app.route('/api/create/parkinglot', methods=['POST'])
 @jwt_required()
 def create_parkinglot():
@@ -71,24 +148,36 @@ def create_parkinglot():
         return jsonify({'message': 'Admin access required'}), 403
 
     data = request.get_json()
-    parkinglot = ParkingLot(
-        name=data['name'],
-        city=data['city'],
-        location=data['location'],
-        price=data['price'],
-        total_spots=data['total_spots']
-    )
-    db.session.add(parkinglot)
+    parkinglot = create_lot_with_spots(data)
     db.session.commit()
-    
-    for i in range(parkinglot.total_spots):
-        parking_spot = ParkingSpot(parking_lot_id=parkinglot.id)
-        
-        db.session.add(parking_spot)
-        db.session.commit()
+    spot_calendar.load_lot(parkinglot.id)
+    invalidate('parkinglots')
 
     return jsonify({'message': 'Parking lot created successfully'}), 200
 
+@app.route('/api/import/parkinglots', methods=['POST'])
+@jwt_required()
+def import_parkinglots():
+    if get_jwt().get('role') != 'admin':
+        return jsonify({'message': 'Admin access required'}), 403
+
+    body = request.get_json(silent=True)
+    lots = body.get('parkinglots', []) if isinstance(body, dict) else None
+    if not isinstance(lots, list):
+        return jsonify({'message': '{"parkinglots": [...]} is required'}), 400
+    for index, lot in enumerate(lots):
+        error = lot_error(lot)
+        if error:
+            return jsonify({'message': f'parkinglots[{index}]: {error}', 'index': index}), 400
+    parkinglots = import_lots(lots)
+    db.session.commit()
+    for parkinglot in parkinglots:
+        spot_calendar.load_lot(parkinglot.id)
+    invalidate('parkinglots')
+
+    total_spots = sum(parkinglot.total_spots for parkinglot in parkinglots)
+    return jsonify({'message': 'Parking lots imported successfully', 'lots': len(parkinglots), 'spots': total_spots}), 200
+
 @app.route('/api/update/parkinglot/<int:parkinglot_id>', methods=['PUT'])
 @jwt_required()
 def update_parkinglot(parkinglot_id):
@@ -107,9 +196,31 @@ def update_parkinglot(parkinglot_id):
     parkinglot.total_spots = data.get('total_spots', parkinglot.total_spots)
 
     db.session.commit()
+    invalidate('parkinglots')
 
     return jsonify({'message': 'Parking lot updated successfully'}), 200
 
+@app.route('/api/update/parkinglot/<int:parkinglot_id>/rates', methods=['PUT'])
+@jwt_required()
+def update_parkinglot_rates(parkinglot_id):
+    # {'multipliers': [24 numbers]} scales the price hour by hour of the day; [] goes back to the flat price
+    if get_jwt().get('role') != 'admin':
+        return jsonify({'message': 'Admin access required'}), 403
+
+    parkinglot = db.session.get(ParkingLot, parkinglot_id)
+    if not parkinglot or parkinglot.is_deleted:
+        return jsonify({'message': 'Parking lot not found'}), 404
+
+    multipliers = request.get_json().get('multipliers')
+    if not isinstance(multipliers, list) or len(multipliers) not in (0, HOURS_PER_DAY) or \
+            not all(type(m) in (int, float) and 0 <= m < float('inf') for m in multipliers):
+        return jsonify({'message': f'multipliers must be a list of {HOURS_PER_DAY} non-negative numbers'}), 400
+
+    set_rate_table(parkinglot.id, multipliers)
+    db.session.commit()
+
+    return jsonify({'message': 'Rates updated successfully'}), 200
+
 @app.route('/api/delete/parkinglot/<int:parkinglot_id>', methods=['DELETE'])
 @jwt_required()
 def delete_parkinglot(parkinglot_id):
@@ -121,31 +232,31 @@ def delete_parkinglot(parkinglot_id):
         return jsonify({'message': 'Parking lot not found'}), 404
     parkinglot.is_deleted = True
     db.session.commit()
+    invalidate('parkinglots')
 
     return jsonify({'message': 'Parking lot deleted successfully'}), 200
 
+def parkinglot_json(parkinglot):
+    return {
+        'id': parkinglot.id,
+        'name': parkinglot.name,
+        'city': parkinglot.city,
+        'location': parkinglot.location,
+        'price': parkinglot.price,
+        'total_spots': parkinglot.total_spots
+    }
+
+def parkinglots_page():
+    # the admin and user catalogs are the same list, so they share cache entries
+    return keyset_page(ParkingLot.query.order_by(ParkingLot.id), ParkingLot.id, parkinglot_json)
+
 @app.route('/api/get/parkinglots', methods=['GET'])
 @jwt_required()
-# @cache.cached(timeout=60)
 def get_parkinglots():
     if get_jwt().get('role') != 'admin':
         return jsonify({'message': 'Admin access required'}), 403 
     
-    parkinglots = ParkingLot.query.all()
-    
-    data = []
-    for parkinglot in parkinglots:
-        lot_data = {
-            'id': parkinglot.id,
-            'name': parkinglot.name,
-            'city': parkinglot.city,
-            'location': parkinglot.location,
-            'price': parkinglot.price,
-            'total_spots': parkinglot.total_spots
-        }
-        data.append(lot_data)
-        
-    return jsonify(data)
+    return cached_json(['parkinglots'], parkinglots_page)
 
 
 
@@ -153,40 +264,31 @@ def get_parkinglots():
 @jwt_required()
 def get_data():
     
-    users = User.query.all()
-    data = []
-    for user in users:
-        user_data = {
+    def user_json(user):
+        return {
             'id': user.id,
             'username': user.username,
             'email': user.email,
             }
-        data.append(user_data)
-    return jsonify(data)
+    return keyset_page(User.query.order_by(User.id), User.id, user_json)
 
 
 @app.route('/api/get/user/parkinglots', methods=['GET'])
 @jwt_required()
+@conditional('parkinglots')
 def user_parkinglots():
     
-    parkinglots = ParkingLot.query.all()
-    
-    data = []
-    for parkinglot in parkinglots:
-        lot_data = {
-            'id': parkinglot.id,
-            'name': parkinglot.name,
-            'city': parkinglot.city,
-            'location': parkinglot.location,
-            'price': parkinglot.price,
-            'total_spots': parkinglot.total_spots
-        }
-        data.append(lot_data)
-        
-    return jsonify(data)
+    return cached_json(['parkinglots'], parkinglots_page)
 
 from datetime import datetime
 
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+TIME_PATTERN = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}')  # TIME_FORMAT's shape, far cheaper than strptime on a whole batch
+LOT_ID_RANGE = range(1, 2 ** 63)  # fits the int64 array quote() works on
+
+def valid_vehicle_number(vehicle_number):
+    return isinstance(vehicle_number, str) and 0 < len(vehicle_number.strip()) <= 20  # Reservation.vehicle_number is String(20)
+
 @app.route('/api/user_reservation', methods=['POST'])
 @jwt_required()
 def user_reservation():
@@ -198,114 +300,250 @@ def user_reservation():
     vehicle_number = data.get('vehicle_number')
     start_time = data.get('start_time')
     end_time = data.get('end_time')
-    start = datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
-    end = datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
+    if not valid_vehicle_number(vehicle_number):
+        return jsonify({'message': 'vehicle_number is required, at most 20 characters'}), 400
+    try:
+        start = datetime.strptime(start_time, TIME_FORMAT)
+        end = datetime.strptime(end_time, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return jsonify({'message': 'start_time and end_time are required as YYYY-MM-DDTHH:MM'}), 400
+    if end <= start:
+        return jsonify({'message': 'End time must be after start time'}), 400
     
-    lot = ParkingLot.query.get(selected_lot_id)
-    print(lot.id)
-    if lot:
-        spot = ParkingSpot.query.filter_by(parking_lot_id=lot.id, status='available').first()
-        print(spot)
-        cost = lot.price * ((end - start).total_seconds() / 3600)  # Calculate cost based on hours
-        reservation = Reservation(
-            user_id=get_jwt_identity(),
-            parking_spot_id=spot.id,
-            vehicle_number=vehicle_number,
-            start_time=start,
-            end_time=end,
-            status='active',
-            cost=cost
-        )
-        db.session.add(reservation)
-        db.session.commit()
-        
-        spot.status = 'reserved'
-        db.session.commit()
-    else:
-        return jsonify({'message': 'Parking lot not found'}), 404    
+    lot = db.session.get(ParkingLot, selected_lot_id)
+    if not lot or lot.is_deleted:
+        return jsonify({'message': 'Parking lot not found'}), 404
+
+    cost = booking_cost(lot.id, start, end)  # price per hour, scaled by the lot's hourly rates
+    reservation = book_spot(lot, get_jwt_identity(), vehicle_number, start, end, cost)
+    if not reservation:
+        return jsonify({'message': 'No available parking spot'}), 400
+    reservations_changed(reservation.user_id)
 
-    # Implement reservation logic here
     return jsonify({'message': 'Reservation created successfully'}), 200
 
+@app.route('/api/user_reservations/batch', methods=['POST'])
+@jwt_required()
+def user_reservations_batch():
+    # {'selected_lot', 'reservations': [{vehicle_number, start_time, end_time}, ...], 'all_or_nothing': false}
+    # books a fleet on one lot in one transaction; results[i] is {'status': 'booked', 'reservation_id', 'spot_id', 'cost'}
+    # or {'status': 'invalid' | 'full' | 'skipped', 'message'}. With all_or_nothing nothing is booked unless every
+    # item can be, and the items that were not invalid come back skipped
+    data = request.get_json(silent=True) or {}
+    items = data.get('reservations')
+    all_or_nothing = bool(data.get('all_or_nothing', False))
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_BOOKINGS:
+        return jsonify({'message': f'reservations must be a list of 1 to {MAX_BATCH_BOOKINGS} items'}), 400
+
+    lot = db.session.get(ParkingLot, data.get('selected_lot'))
+    if not lot or lot.is_deleted:
+        return jsonify({'message': 'Parking lot not found'}), 404
+
+    results = [None] * len(items)
+    valid = []
+    for i, item in enumerate(items):
+        try:
+            start = datetime.strptime(item['start_time'], TIME_FORMAT)
+            end = datetime.strptime(item['end_time'], TIME_FORMAT)
+            vehicle_number = item['vehicle_number']
+        except (KeyError, TypeError, ValueError):
+            results[i] = {'status': 'invalid', 'message': 'vehicle_number, start_time and end_time are required as YYYY-MM-DDTHH:MM'}
+            continue
+        if not valid_vehicle_number(vehicle_number):
+            results[i] = {'status': 'invalid', 'message': 'vehicle_number is required, at most 20 characters'}
+            continue
+        if end <= start:
+            results[i] = {'status': 'invalid', 'message': 'End time must be after start time'}
+            continue
+        valid.append((i, {'vehicle_number': vehicle_number, 'start_time': start, 'end_time': end}))
+
+    if valid and not (all_or_nothing and len(valid) < len(items)):
+        windows = [item for i, item in valid]
+        costs = quote([lot.id] * len(windows), np.array([item['start_time'] for item in windows], dtype='datetime64[m]'),
+                      np.array([item['end_time'] for item in windows], dtype='datetime64[m]'))
+        for item, cost in zip(windows, costs.tolist()):
+            item['cost'] = cost
+        reservations = book_spots(lot, get_jwt_identity(), windows, all_or_nothing)
+        for (i, item), reservation in zip(valid, reservations):
+            if reservation:
+                results[i] = {'status': 'booked', 'reservation_id': reservation.id,
+                              'spot_id': reservation.parking_spot_id, 'cost': reservation.cost}
+    for i, result in enumerate(results):
+        if result is None and all_or_nothing:
+            results[i] = {'status': 'skipped', 'message': 'The batch could not be booked in full'}
+        elif result is None:
+            results[i] = {'status': 'full', 'message': 'No available parking spot'}
+
+    booked = sum(result['status'] == 'booked' for result in results)
+    if booked:
+        reservations_changed(get_jwt_identity())
+    return jsonify({'booked': booked, 'results': results}), 200
+
+@app.route('/api/quotes', methods=['POST'])
+@jwt_required()
+def quotes():
+    # {'quotes': [{'lot_id', 'start_time', 'end_time'}, ...]} -> {'costs': [...]} in the same order,
+    # priced in one vectorized pass; a cost is null when the lot does not exist or end is not after start
+    items = (request.get_json(silent=True) or {}).get('quotes')
+    if not isinstance(items, list) or len(items) > MAX_QUOTES:
+        return jsonify({'message': f'quotes must be a list of at most {MAX_QUOTES} items'}), 400
+    try:
+        # numpy would take a float or bool lot id and a bare date, so check the types and shapes first;
+        # numpy still rejects a well-shaped time that does not exist (month 13, 25:00)
+        for item in items:
+            lot_id, start_time, end_time = item['lot_id'], item['start_time'], item['end_time']
+            if type(lot_id) is not int or lot_id not in LOT_ID_RANGE or \
+                    not all(isinstance(value, str) and TIME_PATTERN.fullmatch(value) for value in (start_time, end_time)):
+                raise ValueError(item)
+        lot_ids = np.array([item['lot_id'] for item in items], dtype=np.int64)
+        starts = np.array([item['start_time'] for item in items], dtype='datetime64[m]')
+        ends = np.array([item['end_time'] for item in items], dtype='datetime64[m]')
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return jsonify({'message': 'every quote needs lot_id, start_time and end_time as YYYY-MM-DDTHH:MM'}), 400
+
+    costs = quote(lot_ids, starts, ends)
+    return jsonify({'costs': [None if np.isnan(cost) else cost for cost in costs.tolist()]})
+
+@app.route('/api/parkinglots/<int:parkinglot_id>/availability', methods=['GET'])
+@jwt_required()
+def lot_availability(parkinglot_id):
+    # ?start=&end= in the same format as a booking; spots with no active reservation overlapping the window
+    lot = db.session.get(ParkingLot, parkinglot_id)
+    if not lot or lot.is_deleted:
+        return jsonify({'message': 'Parking lot not found'}), 404
+    try:
+        start = datetime.strptime(request.args['start'], TIME_FORMAT)
+        end = datetime.strptime(request.args['end'], TIME_FORMAT)
+    except (KeyError, ValueError):
+        return jsonify({'message': 'start and end are required as YYYY-MM-DDTHH:MM'}), 400
+    if end <= start:
+        return jsonify({'message': 'End time must be after start time'}), 400
+
+    spot_ids = sorted(spot_calendar.free_spots(lot.id, start, end))
+    return jsonify({
+        'lot_id': lot.id,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'free_spots': len(spot_ids),
+        'spot_ids': spot_ids
+    })
+
 @app.route('/api/user_reservations/<int:reservation_id>/release', methods=['PUT'])
 @jwt_required()
 def release_reservation(reservation_id):
     user_id = get_jwt_identity()
-    reservation = Reservation.query.get(reservation_id)
+    reservation = db.session.get(Reservation, reservation_id)
     if not reservation or reservation.status != 'active' or reservation.user_id != user_id:
         return jsonify({'message': 'Reservation not found or already released'}), 404
     
-    reservation.status = 'completed'
-    db.session.commit()
-    
-    spot = ParkingSpot.query.get(reservation.parking_spot_id)
-    spot.status = 'available'
-    db.session.commit()
+    if not release_booking(reservation):
+        return jsonify({'message': 'Reservation not found or already released'}), 404
+    reservations_changed(user_id)
     
     return jsonify({'message': 'Reservation released successfully'}), 200
 
+def reservation_rows():
+    # one joined query for reservation + spot + lot, loading only the columns the JSON needs
+    return db.session.query(
+        Reservation.id,
+        Reservation.vehicle_number,
+        Reservation.start_time,
+        Reservation.end_time,
+        Reservation.status,
+        Reservation.cost,
+        ParkingSpot.id.label('spot_id'),
+        ParkingLot.id.label('lot_id'),
+        ParkingLot.name.label('lot_name'),
+        ParkingLot.city.label('lot_city'),
+        ParkingLot.location.label('lot_location'),
+        ParkingLot.price.label('lot_price')
+    ).join(ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id
+    ).join(ParkingLot, ParkingSpot.parking_lot_id == ParkingLot.id
+    ).order_by(Reservation.id)
+
+@app.route('/api/admin/occupancy', methods=['GET'])
+@jwt_required()
+def admin_occupancy():
+    # ?lot_id=&from=&to=&bucket=hour|day, read from the lot_occupancy rollups only; lot_id left out means all lots
+    if get_jwt().get('role') != 'admin':
+        return jsonify({'message': 'Admin access required'}), 403
+    bucket = request.args.get('bucket', 'hour')
+    if bucket not in ('hour', 'day'):
+        return jsonify({'message': 'bucket must be hour or day'}), 400
+    try:
+        start = datetime.strptime(request.args['from'], TIME_FORMAT)
+        end = datetime.strptime(request.args['to'], TIME_FORMAT)
+    except (KeyError, ValueError):
+        return jsonify({'message': 'from and to are required as YYYY-MM-DDTHH:MM'}), 400
+
+    lot_id = request.args.get('lot_id', type=int)
+    if lot_id is None and 'lot_id' in request.args:
+        return jsonify({'message': 'lot_id must be an integer'}), 400
+    spots = db.session.query(func.sum(ParkingLot.total_spots))
+    if lot_id is not None:
+        spots = spots.filter(ParkingLot.id == lot_id)
+    else:
+        spots = spots.filter(ParkingLot.is_deleted == False)
+    spot_hours_per_bucket = (spots.scalar() or 0) * (24 if bucket == 'day' else 1)
+
+    return jsonify({
+        'lot_id': lot_id,
+        'bucket': bucket,
+        'points': [{
+            'time': time.isoformat(),
+            'spot_hours': spot_hours,
+            'revenue': revenue,
+            'occupancy': spot_hours / spot_hours_per_bucket if spot_hours_per_bucket else None
+        } for time, spot_hours, revenue in occupancy_series(start, end, lot_id, bucket)]
+    })
+
+def reservation_export_rows():
+    # reservation_rows() plus the owner's name, for the exports and reports
+    return reservation_rows().add_columns(User.username.label('user_name')).outerjoin(User, Reservation.user_id == User.id)
+
+def reservation_json(row):
+    return {
+        'id': row.id,
+        'vehicle_number': row.vehicle_number,
+        'start_time': row.start_time.isoformat(),
+        'end_time': row.end_time.isoformat(),
+        'status': row.status,
+        'cost': row.cost,
+        'parking_lot': {
+            'id': row.lot_id,
+            'name': row.lot_name,
+            'city': row.lot_city,
+            'location': row.lot_location,
+            'price': row.lot_price
+        }
+    }
+
 @app.route('/api/user/my_reservations', methods=['GET'])
 @jwt_required()
+@cached_per_user
 def my_reservations():
     user_id = get_jwt_identity()
-    reservations = Reservation.query.filter_by(user_id=user_id).all()
-    data = []
-    
-    for reservation in reservations:
-        spot = ParkingSpot.query.get(reservation.parking_spot_id)
-        lot = ParkingLot.query.get(spot.parking_lot_id)
-        reservation_data = {
-            'id': reservation.id,
-            'vehicle_number': reservation.vehicle_number,
-            'start_time': reservation.start_time.isoformat(),
-            'end_time': reservation.end_time.isoformat(),
-            'status': reservation.status,
-            'cost': reservation.cost,
-            'parking_lot': {
-                'id': lot.id,
-                'name': lot.name,
-                'city': lot.city,
-                'location': lot.location,
-                'price': lot.price
-            }
-        }
-        data.append(reservation_data)
+    rows = reservation_rows().filter(Reservation.user_id == user_id).all()
+    data = [reservation_json(row) for row in rows]
     
     return jsonify(data)
 
 @app.route('/api/admin/reservations', methods=['GET'])
 @jwt_required()
+@conditional('reservations', 'parkinglots')
 def admin_reservations():
     if get_jwt().get('role') != 'admin':
         return jsonify({'message': 'Admin access required'}), 403
 
-    reservations = Reservation.query.all()
-    data = []
-
-    for reservation in reservations:
-        user = User.query.get(reservation.user_id)
-        spot = ParkingSpot.query.get(reservation.parking_spot_id)
-        lot = ParkingLot.query.get(spot.parking_lot_id)
-        reservation_data = {
-            'id': reservation.id,
-            'user_name': user.username if user else None,
-            'vehicle_number': reservation.vehicle_number,
-            'start_time': reservation.start_time.isoformat(),
-            'end_time': reservation.end_time.isoformat(),
-            'spot_number': spot.id if spot else None,
-            'status': reservation.status,
-            'cost': reservation.cost,
-            'parking_lot': {
-                'id': lot.id,
-                'name': lot.name,
-                'city': lot.city,
-                'location': lot.location,
-                'price': lot.price
-            }
-        }
-        data.append(reservation_data)
+    rows = reservation_rows().add_columns(User.username).outerjoin(User, Reservation.user_id == User.id)
 
-    return jsonify(data)
+    def admin_reservation_json(row):
+        reservation_data = reservation_json(row)
+        reservation_data['user_name'] = row.username
+        reservation_data['spot_number'] = row.spot_id
+        return reservation_data
+
+    return keyset_page(rows, Reservation.id, admin_reservation_json)
 
 @app.route('/api/export/reservations', methods=['GET'])
 @jwt_required()
@@ -315,88 +553,102 @@ def export_reservations():
     export_reservations_report.delay(user_id)
     return jsonify({'message': 'Reservations report is being generated and will be sent to your email shortly.'}), 200
 
+@app.route('/api/export/reservations.<fmt>', methods=['GET'])
+@jwt_required()
+def stream_reservations(fmt):
+    # rows are read through a server-side cursor and written out as they arrive,
+    # so memory stays flat however many reservations are exported
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'message': 'Unknown export format'}), 404
+
+    rows = reservation_export_rows()
+    if get_jwt().get('role') != 'admin':
+        rows = rows.filter(Reservation.user_id == get_jwt_identity())
+    elif 'user_id' in request.args:
+        user_id = request.args.get('user_id', type=int)
+        if user_id is None:
+            return jsonify({'message': 'user_id must be an integer'}), 400
+        rows = rows.filter(Reservation.user_id == user_id)
+
+    chunks, mimetype = EXPORT_FORMATS[fmt]
+    return Response(
+        stream_with_context(chunks(rows.yield_per(EXPORT_CHUNK_ROWS))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=reservations.{fmt}'}
+    )
+
 @app.route('/api/user/summary', methods=['GET'])
 @jwt_required()
+@cached_per_user
 def user_summary():
     user_id = get_jwt_identity()
-    reservations = Reservation.query.filter_by(user_id=user_id).all()
-    lot_summary = {}
-    for reservation in reservations:
-        spot = ParkingSpot.query.get(reservation.parking_spot_id)
-        lot = ParkingLot.query.get(spot.parking_lot_id)
-        if lot.name not in lot_summary:
-            lot_summary[lot.name] = {
-                'total_reservations': 0,
-                'total_cost': 0.0
-            }
-        lot_summary[lot.name]['total_reservations'] += 1
-        lot_summary[lot.name]['total_cost'] += reservation.cost
-        
-    lot_names =[]
-    lot_counts = []
-    lot_costs = []
-    for lot_name, summary in lot_summary.items():
-        lot_names.append(lot_name)  
-        lot_counts.append(summary['total_reservations'])
-        lot_costs.append(summary['total_cost'])
-    
-    total_spent = sum(summary['total_cost'] for summary in lot_summary.values())
-    active_reservations = sum(1 for reservation in reservations if reservation.status == 'active')        
-    completed_reservations = sum(1 for reservation in reservations if reservation.status == 'completed')
+    lot_names, lot_counts, lot_costs = lot_totals(user_id)
+    statuses = status_counts(user_id)
     
     return jsonify({
         'lot_names': lot_names,
         'lot_counts': lot_counts,
         'lot_costs': lot_costs,
-        'total_spent': total_spent,        
-        'active_reservations': active_reservations,        
-        'completed_reservations': completed_reservations,
-        'total': len(reservations)
+        'total_spent': sum(lot_costs),        
+        'active_reservations': statuses.get('active', 0),        
+        'completed_reservations': statuses.get('completed', 0),
+        'total': sum(lot_counts)
         })
 
 
 @app.route('/api/admin/summary', methods=['GET'])
 @jwt_required()
+@conditional('reservations', 'parkinglots')
 def admin_summary():
     if get_jwt().get('role') != 'admin':
         return jsonify({'message': 'Admin access required'}), 403
 
-    reservations = Reservation.query.all()
-    lot_summary = {}
-    for reservation in reservations:
-        spot = ParkingSpot.query.get(reservation.parking_spot_id)
-        lot = ParkingLot.query.get(spot.parking_lot_id)
-        if lot.name not in lot_summary:
-            lot_summary[lot.name] = {
-                'total_reservations': 0,
-                'total_revenue': 0.0
-            }
-        lot_summary[lot.name]['total_reservations'] += 1
-        lot_summary[lot.name]['total_revenue'] += reservation.cost
-        
-    lot_names =[]
-    lot_counts = []
-    lot_revenues = []
-    for lot_name, summary in lot_summary.items():
-        lot_names.append(lot_name)  
-        lot_counts.append(summary['total_reservations'])
-        lot_revenues.append(summary['total_revenue'])
-    
-    total_revenue = sum(summary['total_revenue'] for summary in lot_summary.values())
+    lot_names, lot_counts, lot_revenues = lot_totals()
     
     return jsonify({
         'lot_names': lot_names,
         'lot_counts': lot_counts,
         'lot_revenues': lot_revenues,
-        'total_revenue': total_revenue,        
-        'total_reservations': len(reservations)
+        'total_revenue': sum(lot_revenues),        
+        'total_reservations': sum(lot_counts)
         })
 
+@app.cli.command('rebuild-lot-stats')
+def rebuild_lot_stats_command():
+    # flask --app app rebuild-lot-stats
+    db.create_all()
+    rebuild_lot_stats()
+    cache.clear()  # cached summaries were built from the old stats
+    print('lot_stats rebuilt from reservations')
+
+@app.cli.command('backfill-occupancy')
+def backfill_occupancy_command():
+    # flask --app app backfill-occupancy
+    db.create_all()
+    rebuild_occupancy()
+    print('lot_occupancy rebuilt from completed reservations')
+
+@app.cli.command('prune-revoked-tokens')
+def prune_revoked_tokens_command():
+    # flask --app app prune-revoked-tokens
+    db.create_all()
+    print(f'{revocations.prune()} expired revoked tokens removed')
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    # flask --app app create-indexes
+    if {'lot_stats', 'user_lot_stats'} & create_indexes():
+        rebuild_lot_stats()
+        print('lot_stats built from reservations')
+    print('indexes created')
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        if {'lot_stats', 'user_lot_stats'} & create_indexes():
+            rebuild_lot_stats()  # a database from before the stats tables: fill them from its reservations
         if not User.query.filter_by(username='admin').first():
-            admin = User(username='admin', email='admin@gmail.com', password=generate_password_hash('admin'), role='admin')
+            admin = User(username='admin', email='admin@gmail.com', password=hasher.hash('admin'), role='admin')
             db.session.add(admin)
             db.session.commit()
+        spot_calendar.load()
     app.run(debug=True)
\ No newline at end of file
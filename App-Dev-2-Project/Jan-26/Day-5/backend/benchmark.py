@@ -0,0 +1,504 @@
+# Usage: python benchmark.py <name> [args...]
+# Runs against a throwaway SQLite file so the real instance/parking.db is never touched.
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+os.environ.setdefault('CACHE_TYPE', 'SimpleCache')
+
+from app import app, reservation_rows, reservation_export_rows, TIME_FORMAT
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from flask_jwt_extended import create_access_token
+from models import db, User, ParkingLot, ParkingSpot, Reservation, RevokedToken
+from provisioning import create_lot_with_spots
+from summary import lot_totals, status_counts, rebuild_lot_stats
+from allocator import spot_calendar
+from booking import overlapping, free_spot_in_db
+from export import csv_chunks, EXPORT_CHUNK_ROWS
+from mailer import SMTPPool
+from pricing import set_rate_table, booking_cost
+from passwords import hasher
+from revocation import RevocationList, BloomFilter
+
+
+def reset_db():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def lot_data(total_spots):
+    return {'name': 'Bench Lot', 'city': 'Chennai', 'location': 'IITM', 'price': 20.0, 'total_spots': total_spots}
+
+
+def bench_spots(total_spots='2000'):
+    total_spots = int(total_spots)
+
+    reset_db()
+    start = time.perf_counter()
+    parkinglot = ParkingLot(**lot_data(total_spots))
+    db.session.add(parkinglot)
+    db.session.commit()
+    for i in range(total_spots):
+        db.session.add(ParkingSpot(parking_lot_id=parkinglot.id))
+        db.session.commit()
+    loop_time = time.perf_counter() - start
+
+    reset_db()
+    start = time.perf_counter()
+    create_lot_with_spots(lot_data(total_spots))
+    db.session.commit()
+    bulk_time = time.perf_counter() - start
+
+    assert ParkingSpot.query.count() == total_spots
+    print(f'{total_spots} spots')
+    print(f'commit per spot: {loop_time:8.3f}s  {total_spots / loop_time:12.0f} spots/sec')
+    print(f'bulk insert:     {bulk_time:8.3f}s  {total_spots / bulk_time:12.0f} spots/sec')
+
+
+def seed_reservations(count, lots=10, spots_per_lot=100, users=100):
+    for i in range(lots):
+        create_lot_with_spots(lot_data(spots_per_lot))
+    total_spots = lots * spots_per_lot
+    start, end = datetime(2026, 1, 1, 10, 0), datetime(2026, 1, 1, 12, 0)
+    for offset in range(0, count, 50000):
+        rows = [{
+            'user_id': i % users + 1,
+            'parking_spot_id': i % total_spots + 1,
+            'vehicle_number': f'TN{i:08d}',
+            'start_time': start,
+            'end_time': end,
+            'status': 'active' if i % 10 == 0 else 'completed',
+            'cost': 40.0
+        } for i in range(offset, min(offset + 50000, count))]
+        db.session.execute(insert(Reservation), rows)
+    db.session.commit()
+
+
+def bench_summary(reservations='1000000'):
+    reservations = int(reservations)
+    reset_db()
+    seed_reservations(reservations)
+
+    start = time.perf_counter()
+    rebuild_lot_stats()
+    print(f'rebuild-lot-stats over {reservations} reservations: {time.perf_counter() - start:8.3f} s')
+
+    for label, user_id in [('admin summary', None), ('user summary', 1)]:
+        start = time.perf_counter()
+        lot_totals(user_id)
+        status_counts(user_id)
+        elapsed = time.perf_counter() - start
+        print(f'{label:14} over {reservations} reservations: {elapsed * 1000:8.1f} ms')
+
+
+def bench_allocator(lots='10', spots_per_lot='5000', free_per_lot='20'):
+    # picking a spot for 10:20-12:00 in nearly full lots: every spot but the last free_per_lot of each lot is booked
+    # 10:00-12:00. The free ones are idle, booked on another day or earlier the same day (all found by the slot
+    # masks alone) or booked 10:00-10:20, sharing a quarter hour with the request, which takes the bisect
+    lots, spots_per_lot, free_per_lot = int(lots), int(spots_per_lot), int(free_per_lot)
+    start, end = datetime(2026, 1, 1, 10, 20), datetime(2026, 1, 1, 12)
+    busy = (datetime(2026, 1, 1, 10), end)
+    bookings = lots * free_per_lot
+    print(f'{bookings} spot selections in {lots} lots of {spots_per_lot} spots ({free_per_lot} free each)')
+
+    for label, free_window in (('idle', None), ('other day', (busy[0] + timedelta(days=1), busy[1] + timedelta(days=1))),
+                               ('earlier', (busy[0] - timedelta(hours=2), busy[0])), ('same slot', (busy[0], start))):
+        reset_db()
+        for i in range(lots):
+            create_lot_with_spots(lot_data(spots_per_lot))
+        rows = []
+        for spot_id in range(1, lots * spots_per_lot + 1):
+            free = spot_id % spots_per_lot == 0 or spot_id % spots_per_lot > spots_per_lot - free_per_lot
+            window = free_window if free else busy
+            if window:
+                rows.append({'user_id': 1, 'parking_spot_id': spot_id, 'vehicle_number': f'TN{spot_id:08d}',
+                             'start_time': window[0], 'end_time': window[1], 'status': 'active', 'cost': 40.0})
+        db.session.execute(insert(Reservation), rows)
+        db.session.commit()
+        spot_calendar.load()
+
+        begin = time.perf_counter()
+        for lot_id in range(1, lots + 1):
+            for i in range(free_per_lot):
+                assert free_spot_in_db(lot_id, start, end) is not None
+        sql_time = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        for lot_id in range(1, lots + 1):
+            for i in range(free_per_lot):
+                assert spot_calendar.take(lot_id, start, end) is not None
+        calendar_time = time.perf_counter() - begin
+        assert spot_calendar.take(1, start, end) is None
+
+        print(f'free spots {label + ":":12} overlap query {sql_time * 1000 / bookings:7.3f} ms/selection   '
+              f'calendar {calendar_time * 1000 / bookings:7.3f} ms/selection')
+
+
+def bench_calendar(spots='50', reservations='20000', queries='200'):
+    # one lot with a dense calendar: every spot booked back to back in 1-3 hour windows with short gaps
+    spots, reservations, queries = int(spots), int(reservations), int(queries)
+    reset_db()
+    create_lot_with_spots(lot_data(spots))
+    rng = random.Random(1)
+    rows, latest = [], datetime(2026, 1, 1)
+    for spot_id in range(1, spots + 1):
+        end = datetime(2026, 1, 1)
+        for i in range(reservations // spots):
+            start = end + timedelta(minutes=rng.choice((0, 30, 60)))
+            end = start + timedelta(hours=rng.randint(1, 3))
+            rows.append({'user_id': 1, 'parking_spot_id': spot_id, 'vehicle_number': f'TN{len(rows):08d}',
+                         'start_time': start, 'end_time': end, 'status': 'active', 'cost': 40.0})
+        latest = max(latest, end)
+    db.session.execute(insert(Reservation), rows)
+    db.session.commit()
+    spot_calendar.load()
+
+    span = int((latest - datetime(2026, 1, 1)).total_seconds() // 60)
+    windows = []
+    for i in range(queries):
+        start = datetime(2026, 1, 1) + timedelta(minutes=rng.randrange(span))
+        windows.append((start, start + timedelta(hours=rng.randint(1, 4))))
+
+    start_time = time.perf_counter()
+    in_db = [{spot_id for spot_id, in db.session.query(ParkingSpot.id).filter(
+        ParkingSpot.parking_lot_id == 1, ~overlapping(ParkingSpot.id, start, end))} for start, end in windows]
+    sql_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    in_calendar = [set(spot_calendar.free_spots(1, start, end)) for start, end in windows]
+    calendar_time = time.perf_counter() - start_time
+
+    assert in_db == in_calendar
+    print(f'{queries} availability queries on a lot of {spots} spots with {len(rows)} reservations')
+    print(f'overlap query in SQL: {sql_time * 1000 / queries:8.3f} ms/query')
+    print(f'spot calendar:        {calendar_time * 1000 / queries:8.3f} ms/query')
+
+
+def bench_bookings(bookings='3000', threads='32', total_spots='2500'):
+    # concurrent POST /api/user_reservation against one lot, through the full Flask stack
+    bookings, threads, total_spots = int(bookings), int(threads), int(total_spots)
+    app.config['JWT_VERIFY_SUB'] = False  # the app issues integer identities
+    reset_db()
+    db.session.add(User(id=1, username='bench', email='bench@gmail.com', password='x', role='user'))
+    create_lot_with_spots(lot_data(total_spots))
+    db.session.commit()
+    spot_calendar.load()
+    headers = {'Authorization': 'Bearer ' + create_access_token(identity=1, additional_claims={'role': 'user'})}
+    statuses = []
+
+    def worker(number):
+        with app.test_client() as client:
+            for i in range(number, bookings, threads):
+                response = client.post('/api/user_reservation', headers=headers, json={
+                    'selected_lot': 1,
+                    'vehicle_number': f'TN{i:06d}',
+                    'start_time': '2026-01-01T10:00',
+                    'end_time': '2026-01-01T12:00'
+                })
+                statuses.append(response.status_code)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    spot_ids = [row[0] for row in db.session.query(Reservation.parking_spot_id)]
+    assert len(spot_ids) == len(set(spot_ids)), 'double-booked spot'
+    assert statuses.count(200) == min(bookings, total_spots)
+    print(f'{bookings} bookings from {threads} threads into a {total_spots}-spot lot: '
+          f'{statuses.count(200)} booked, {statuses.count(400)} full, {len(statuses) - statuses.count(200) - statuses.count(400)} errors')
+    print(f'{elapsed:.2f}s, {bookings / elapsed:.0f} bookings/sec, no double-booked spots')
+
+
+def bench_fleet(vehicles='500', total_spots='1000'):
+    # one fleet booked with POST /api/user_reservations/batch against one POST /api/user_reservation per vehicle
+    vehicles, total_spots = int(vehicles), int(total_spots)
+    app.config['JWT_VERIFY_SUB'] = False  # the app issues integer identities
+    headers = {'Authorization': 'Bearer ' + create_access_token(identity=1, additional_claims={'role': 'user'})}
+    fleet = [{'vehicle_number': f'TN{i:06d}', 'start_time': '2026-01-01T10:00', 'end_time': '2026-01-01T12:00'}
+             for i in range(vehicles)]
+
+    def fresh_lot():
+        reset_db()
+        db.session.add(User(id=1, username='bench', email='bench@gmail.com', password='x', role='user'))
+        create_lot_with_spots(lot_data(total_spots))
+        db.session.commit()
+        spot_calendar.load()
+
+    client = app.test_client()
+    fresh_lot()
+    start = time.perf_counter()
+    statuses = [client.post('/api/user_reservation', headers=headers, json=dict(item, selected_lot=1)).status_code
+                for item in fleet]
+    single_time = time.perf_counter() - start
+    assert statuses.count(200) == min(vehicles, total_spots)
+
+    fresh_lot()
+    start = time.perf_counter()
+    response = client.post('/api/user_reservations/batch', headers=headers, json={'selected_lot': 1, 'reservations': fleet})
+    batch_time = time.perf_counter() - start
+    assert response.get_json()['booked'] == min(vehicles, total_spots)
+
+    spot_ids = [row[0] for row in db.session.query(Reservation.parking_spot_id)]
+    assert len(spot_ids) == len(set(spot_ids)), 'double-booked spot'
+    print(f'{vehicles} vehicles into a {total_spots}-spot lot')
+    print(f'one call each: {single_time:7.3f}s  {vehicles / single_time:8.0f} bookings/sec')
+    print(f'one batch:     {batch_time:7.3f}s  {vehicles / batch_time:8.0f} bookings/sec')
+
+
+def bench_logins(logins='200', threads='8', policies='scrypt:32768:8:1,pbkdf2:sha256:600000,pbkdf2:sha256:100000'):
+    # concurrent POST /api/login under each hashing policy, with PASSWORD_HASH_WORKERS hashes on the CPU at a time
+    logins, threads = int(logins), int(threads)
+    cores = min(app.config['PASSWORD_HASH_WORKERS'], os.cpu_count() or 1)
+    print(f'{logins} logins from {threads} threads, {app.config["PASSWORD_HASH_WORKERS"]} hashing workers on {os.cpu_count()} cores')
+    for method in policies.split(','):
+        app.config['PASSWORD_HASH_METHOD'] = method
+        reset_db()
+        db.session.add(User(id=1, username='bench', email='bench@gmail.com', password=hasher.hash('secret'), role='user'))
+        db.session.commit()
+        statuses = []
+
+        def worker(number):
+            with app.test_client() as client:
+                for i in range(number, logins, threads):
+                    statuses.append(client.post('/api/login', json={'username': 'bench', 'password': 'secret'}).status_code)
+
+        workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        ok = statuses.count(200)
+        print(f'{method:24} {ok / elapsed:8.1f} logins/sec  {ok / elapsed / cores:8.1f} per core  {statuses.count(503)} shed with 503')
+
+
+def bench_pages(reservations='1000000', limit='100'):
+    reservations, limit = int(reservations), int(limit)
+    reset_db()
+    seed_reservations(reservations)
+
+    print(f'page of {limit} from {reservations} reservations')
+    for depth in (0, reservations // 2, reservations - limit):
+        start = time.perf_counter()
+        reservation_rows().filter(Reservation.id > depth).limit(limit).all()
+        keyset_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reservation_rows().offset(depth).limit(limit).all()
+        offset_time = time.perf_counter() - start
+        print(f'depth {depth:8}: keyset {keyset_time * 1000:7.2f} ms   offset {offset_time * 1000:7.2f} ms')
+
+
+def bench_export(reservations='200000'):
+    reservations = int(reservations)
+    reset_db()
+    seed_reservations(reservations)
+    rows = reservation_export_rows()
+
+    def measure(export):
+        db.session.expire_all()
+        tracemalloc.start()
+        start = time.perf_counter()
+        size = export()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size, elapsed, peak
+
+    def whole_list():
+        return len(''.join(csv_chunks([record for record in rows.all()])))
+
+    def streamed():
+        return sum(len(chunk) for chunk in csv_chunks(rows.yield_per(EXPORT_CHUNK_ROWS)))
+
+    print(f'CSV export of {reservations} reservations')
+    for label, export in [('list + join', whole_list), ('streamed', streamed)]:
+        size, elapsed, peak = measure(export)
+        print(f'{label:12}: {size / 1e6:7.1f} MB out in {elapsed:6.2f}s, peak python memory {peak / 1e6:8.1f} MB')
+
+
+def bench_quotes(quotes='10000', lots='50', repeats='20'):
+    # POST /api/quotes through the full Flask stack, JSON parsing and all, against per-item Python pricing
+    quotes, lots, repeats = int(quotes), int(lots), int(repeats)
+    app.config['JWT_VERIFY_SUB'] = False  # the app issues integer identities
+    reset_db()
+    for i in range(lots):
+        create_lot_with_spots(lot_data(1))
+    db.session.commit()
+    for lot_id in range(1, lots + 1, 2):
+        set_rate_table(lot_id, [1.5 if 8 <= hour < 20 else 0.8 for hour in range(24)])
+    db.session.commit()
+    headers = {'Authorization': 'Bearer ' + create_access_token(identity=1, additional_claims={'role': 'user'})}
+
+    random.seed(1)
+    items = []
+    for i in range(quotes):
+        start = datetime(2026, 1, 1) + timedelta(minutes=random.randrange(0, 30 * 24 * 60, 15))
+        end = start + timedelta(minutes=random.randrange(15, 72 * 60, 15))
+        items.append({'lot_id': random.randint(1, lots), 'start_time': start.strftime(TIME_FORMAT), 'end_time': end.strftime(TIME_FORMAT)})
+
+    client = app.test_client()
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        response = client.post('/api/quotes', headers=headers, json={'quotes': items})
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    costs = response.get_json()['costs']
+
+    start = time.perf_counter()
+    single = [booking_cost(item['lot_id'], datetime.strptime(item['start_time'], TIME_FORMAT),
+                           datetime.strptime(item['end_time'], TIME_FORMAT)) for item in items[:200]]
+    single_time = (time.perf_counter() - start) / 200 * quotes
+    assert single == costs[:200]
+
+    timings.sort()
+    print(f'{quotes} quotes over {lots} lots, half of them with hourly rates')
+    print(f'POST /api/quotes: median {timings[len(timings) // 2] * 1000:7.1f} ms  best {timings[0] * 1000:7.1f} ms')
+    print(f'one at a time:    {single_time * 1000:7.1f} ms (extrapolated from 200)')
+
+
+def bench_revocations(revoked='100000', checks='100000', exact_checks='2000'):
+    # false positive rate of the revocation Bloom filter, and the cost of a check against a lookup per request
+    revoked, checks, exact_checks = int(revoked), int(checks), int(exact_checks)
+    reset_db()
+    expires = int(time.time()) + 3600
+    for offset in range(0, revoked, 50000):
+        db.session.execute(insert(RevokedToken), [{'jti': str(uuid.uuid4()), 'expires': expires}
+                                                   for i in range(offset, min(offset + 50000, revoked))])
+    db.session.commit()
+
+    revocations = RevocationList(capacity=revoked)
+    start = time.perf_counter()
+    revocations.load()
+    load_time = time.perf_counter() - start
+    bloom = revocations.filter
+    unseen = [str(uuid.uuid4()) for i in range(checks)]
+
+    start = time.perf_counter()
+    hits = sum(jti in bloom for jti in unseen)
+    bloom_time = (time.perf_counter() - start) / checks
+
+    # load() leaves room to grow; a filter filled to its capacity shows the worst case
+    full = BloomFilter(revoked, bloom.error_rate)
+    for (jti,) in db.session.query(RevokedToken.jti):
+        full.add(jti)
+    full_hits = sum(jti in full for jti in unseen)
+
+    start = time.perf_counter()
+    for jti in unseen[:exact_checks]:
+        revocations.is_revoked(jti)
+    check_time = (time.perf_counter() - start) / exact_checks
+
+    start = time.perf_counter()
+    for jti in unseen[:exact_checks]:
+        db.session.query(RevokedToken.id).filter(RevokedToken.jti == jti).first()
+    lookup_time = (time.perf_counter() - start) / exact_checks
+
+    print(f'{revoked} revoked tokens: filter of {bloom.size / 8 / 1024:.0f} KiB, {bloom.hashes} hashes, loaded in {load_time:.2f}s')
+    for name, result, hit_count in (('as loaded', bloom, hits), ('at capacity', full, full_hits)):
+        expected = (1 - math.exp(-result.hashes * result.count / result.size)) ** result.hashes
+        print(f'false positives {name + ":":12} {hit_count} of {checks} unrevoked tokens = {hit_count / checks:.4%}  '
+              f'(expected {expected:.4%})')
+    print(f'filter check:    {bloom_time * 1e6:7.2f} us')
+    print(f'is_revoked:      {check_time * 1e6:7.2f} us')
+    print(f'table lookup:    {lookup_time * 1e6:7.2f} us')
+
+
+def smtp_sink(refuse=()):
+    # local SMTP server that accepts any login and drops the messages; needs `pip install aiosmtpd`.
+    # A message containing one of the refuse strings is rejected with a 554
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+
+    class Sink:
+        received = 0
+
+        async def handle_DATA(self, server, session, envelope):
+            if any(text.encode() in envelope.content for text in refuse):
+                return '554 Message rejected'
+            Sink.received += 1
+            return '250 OK'
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    controller = Controller(Sink(), hostname='127.0.0.1', port=port,
+                            authenticator=lambda *args: AuthResult(success=True), auth_require_tls=False)
+    controller.start()
+    return controller, Sink
+
+
+def bench_mail(messages='500'):
+    import smtplib
+    import tasks
+    messages = int(messages)
+    controller, sink = smtp_sink()
+    host, port = controller.hostname, controller.port
+    emails = [(f'user{i}@gmail.com', 'Daily Reminder', f'Reminder {i}') for i in range(messages)]
+
+    start = time.perf_counter()
+    for email in emails:
+        # what send_email used to do for every message
+        connection = smtplib.SMTP(host, port)
+        connection.login(tasks.SENDER_ADDRESS, tasks.SENDER_PASSWORD)
+        connection.send_message(tasks.build_email(*email))
+        connection.quit()
+    per_message_time = time.perf_counter() - start
+
+    tasks.mailer = SMTPPool(host, port, tasks.SENDER_ADDRESS, tasks.SENDER_PASSWORD)
+    start = time.perf_counter()
+    for email in emails:
+        tasks.send_email(*email)
+    pooled_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tasks.send_emails(emails)
+    batch_time = time.perf_counter() - start
+
+    tasks.mailer.close_all()
+    controller.stop()
+    assert sink.received == 3 * messages
+    print(f'{messages} messages to a local SMTP sink')
+    print(f'connect + login per message: {messages / per_message_time:8.0f} messages/sec')
+    print(f'pooled send_email:           {messages / pooled_time:8.0f} messages/sec')
+    print(f'batched send_emails:         {messages / batch_time:8.0f} messages/sec')
+
+
+BENCHMARKS = {
+    'spots': bench_spots,
+    'summary': bench_summary,
+    'allocator': bench_allocator,
+    'calendar': bench_calendar,
+    'bookings': bench_bookings,
+    'fleet': bench_fleet,
+    'logins': bench_logins,
+    'pages': bench_pages,
+    'export': bench_export,
+    'quotes': bench_quotes,
+    'mail': bench_mail,
+    'revocations': bench_revocations,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: python benchmark.py <' + '|'.join(BENCHMARKS) + '> [args...]')
+        sys.exit(1)
+    with app.app_context():
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,175 @@
+import time
+from sqlalchemy import update, insert, select, literal, and_
+from sqlalchemy.exc import OperationalError
+from models import db, ParkingSpot, Reservation
+from allocator import spot_calendar
+from summary import reservation_booked, reservations_booked, reservation_released
+
+TRANSACTION_RETRIES = 5
+CLAIM_ATTEMPTS = 5
+MAX_BATCH_BOOKINGS = 1000
+
+
+def run_in_transaction(work, on_rollback=None, retries=TRANSACTION_RETRIES):
+    # SQLite reports write contention as "database is locked"; roll back and run the whole transaction again.
+    # Any other error is raised after the rollback, so on_rollback always undoes what work() did outside the database
+    for attempt in range(retries):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except Exception as error:
+            db.session.rollback()
+            if on_rollback:
+                on_rollback()
+            if not isinstance(error, OperationalError) or attempt == retries - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+
+def overlapping(spot_id, start, end):
+    # true when an active reservation on the spot overlaps [start, end). Windows on a spot never overlap,
+    # so only the last one starting before end can reach past start, and ix_reservation_spot_window
+    # finds it with one seek however long the spot's calendar is
+    last_end = select(Reservation.end_time).where(
+        Reservation.parking_spot_id == spot_id,
+        Reservation.status == 'active',
+        Reservation.start_time < end
+    ).order_by(Reservation.start_time.desc()).limit(1).scalar_subquery()
+    return and_(last_end.is_not(None), last_end > start)
+
+
+def insert_if_free(values):
+    # "insert the reservation where no active reservation overlaps it" as one statement, so two
+    # transactions can never both book overlapping windows on a spot; returns the new id or None
+    columns = Reservation.__table__.c
+    row = select(*[literal(value, columns[name].type) for name, value in values.items()]).where(
+        ~overlapping(values['parking_spot_id'], values['start_time'], values['end_time'])
+    )
+    result = db.session.execute(insert(Reservation).from_select(list(values), row))
+    return result.lastrowid if result.rowcount else None
+
+
+def free_spot_in_db(parking_lot_id, start, end):
+    return db.session.query(ParkingSpot.id).filter(
+        ParkingSpot.parking_lot_id == parking_lot_id, ~overlapping(ParkingSpot.id, start, end)
+    ).limit(1).scalar()
+
+
+def claim_spot(parking_lot_id, values, taken):
+    # a candidate that turns out to be taken (stale calendar, another worker) just moves us on to the next one;
+    # every spot booked in the calendar is appended to taken so a rollback can hand it back.
+    # Returns (spot id, reservation id), or (None, None) when the lot is full for the window
+    start, end = values['start_time'], values['end_time']
+    for attempt in range(CLAIM_ATTEMPTS + 1):
+        spot_id = spot_calendar.take(parking_lot_id, start, end) if attempt < CLAIM_ATTEMPTS else None
+        if spot_id is None:
+            # nothing (left) in the calendar: the database may know of a release this process has not seen
+            spot_id = free_spot_in_db(parking_lot_id, start, end)
+            if spot_id is None or not spot_calendar.add(parking_lot_id, spot_id, start, end):
+                return None, None  # full, or the last free spot is being booked by another request right now
+        taken.append(spot_id)
+        reservation_id = insert_if_free(dict(values, parking_spot_id=spot_id))
+        if reservation_id:
+            return spot_id, reservation_id
+    return None, None
+
+
+def book_spot(lot, user_id, vehicle_number, start, end, cost):
+    # claim + reservation insert + stats in one transaction; returns None when the lot is full for the window
+    claimed = []
+
+    def work():
+        values = {
+            'user_id': user_id,
+            'vehicle_number': vehicle_number,
+            'start_time': start,
+            'end_time': end,
+            'status': 'active',
+            'cost': cost
+        }
+        spot_id, reservation_id = claim_spot(lot.id, values, claimed)
+        if spot_id is None:
+            return None
+        # status only says the spot has active reservations; availability comes from their windows
+        db.session.execute(update(ParkingSpot).where(ParkingSpot.id == spot_id).values(status='reserved'))
+        reservation = db.session.get(Reservation, reservation_id)
+        reservation_booked(lot.id, reservation)
+        return reservation
+
+    def give_back():
+        while claimed:
+            spot_calendar.remove(lot.id, claimed.pop(), start, end)
+
+    reservation = run_in_transaction(work, on_rollback=give_back)
+    spot_calendar.settle(lot.id, [(spot_id, start, end) for spot_id in claimed])
+    return reservation
+
+
+def book_spots(lot, user_id, items, all_or_nothing=False):
+    # items are {'vehicle_number', 'start_time', 'end_time', 'cost'} dicts booked for one user on one lot in one
+    # transaction: spots for every window come from one pass over the calendar, the spot statuses and stats are
+    # written with one statement each. Returns a reservation or None (no free spot) per item; with
+    # all_or_nothing, all None unless every item could be booked
+    claimed = []
+
+    def work():
+        spot_ids = spot_calendar.take_many(lot.id, [(item['start_time'], item['end_time']) for item in items])
+        booked = []
+        for item, spot_id in zip(items, spot_ids):
+            values = dict(item, user_id=user_id, status='active')
+            reservation_id = None
+            if spot_id is not None:
+                claimed.append((spot_id, item['start_time'], item['end_time']))
+                reservation_id = insert_if_free(dict(values, parking_spot_id=spot_id))
+            if not reservation_id:
+                # full in the calendar, or it was stale: the single booking path tries the next spots and the database
+                taken = []
+                spot_id, reservation_id = claim_spot(lot.id, values, taken)
+                claimed.extend((taken_id, item['start_time'], item['end_time']) for taken_id in taken)
+            booked.append((spot_id, reservation_id))
+
+        if all_or_nothing and any(reservation_id is None for spot_id, reservation_id in booked):
+            db.session.rollback()
+            give_back()
+            return [None] * len(items)
+
+        reservation_ids = [reservation_id for spot_id, reservation_id in booked if reservation_id]
+        spot_ids = {spot_id for spot_id, reservation_id in booked if reservation_id}
+        db.session.execute(update(ParkingSpot).where(ParkingSpot.id.in_(spot_ids)).values(status='reserved'))
+        reservations = {reservation.id: reservation for reservation in
+                        Reservation.query.filter(Reservation.id.in_(reservation_ids))}
+        if reservations:
+            reservations_booked(lot.id, user_id, list(reservations.values()))
+        return [reservations.get(reservation_id) for spot_id, reservation_id in booked]
+
+    def give_back():
+        while claimed:
+            spot_calendar.remove(lot.id, *claimed.pop())
+
+    reservations = run_in_transaction(work, on_rollback=give_back)
+    spot_calendar.settle(lot.id, claimed)
+    return reservations
+
+
+def release_booking(reservation):
+    # returns False if the reservation was already released by a concurrent request
+    spot = db.session.get(ParkingSpot, reservation.parking_spot_id)
+
+    def work():
+        released = db.session.execute(
+            update(Reservation)
+            .where(Reservation.id == reservation.id, Reservation.status == 'active')
+            .values(status='completed')
+        ).rowcount
+        if not released:
+            return False
+        still_booked = select(Reservation.id).where(Reservation.parking_spot_id == spot.id, Reservation.status == 'active').exists()
+        db.session.execute(update(ParkingSpot).where(ParkingSpot.id == spot.id, ~still_booked).values(status='available'))
+        reservation_released(spot.parking_lot_id, reservation)
+        return True
+
+    released = run_in_transaction(work)
+    if released:
+        spot_calendar.remove(spot.parking_lot_id, spot.id, reservation.start_time, reservation.end_time)
+    return released
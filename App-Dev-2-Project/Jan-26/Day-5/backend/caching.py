@@ -0,0 +1,93 @@
+import hashlib
+import time
+from functools import wraps
+from flask import request, make_response, Response
+from flask_caching import Cache
+from flask_jwt_extended import get_jwt_identity, get_jwt
+
+cache = Cache()
+
+CACHE_TIMEOUT = 60 * 60  # entries are invalidated explicitly, the timeout only clears out old versions
+# version keys never expire: one that came back lower than before would serve bodies cached under that version again
+VERSION_TIMEOUT = 0
+
+
+def seed_version(key):
+    # start from the clock rather than 0 so an emptied cache never hands out an old version again
+    cache.add(key, time.time_ns() // 1000, timeout=VERSION_TIMEOUT)
+
+
+def current_versions(namespaces):
+    keys = [f'{namespace}:version' for namespace in namespaces]
+    versions = cache.get_many(*keys)
+    for i, version in enumerate(versions):
+        if version is None:
+            seed_version(keys[i])
+            versions[i] = cache.get(keys[i])
+    return versions
+
+
+def cached_json(namespaces, build, key='', timeout=CACHE_TIMEOUT):
+    # build() returns a JSON response; its serialized body is stored as bytes under the current
+    # version of every namespace it depends on, so a hit costs one cache round trip and no database work
+    versions = current_versions(namespaces)
+    full_key = ':'.join(namespaces + [str(version or 0) for version in versions] + [key, request.query_string.decode()])
+    body = cache.get(full_key)
+    if body is None:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        cache.set(full_key, body, timeout=timeout)
+    return Response(body, mimetype='application/json')
+
+
+def invalidate(namespace):
+    # bump the version instead of deleting keys, which works the same on SimpleCache and RedisCache.
+    # A missing key is seeded first; inc() on its own would restart it at 1
+    key = f'{namespace}:version'
+    seed_version(key)
+    cache.cache.inc(key)
+
+
+def user_namespace(user_id):
+    return f'user:{user_id}'
+
+
+def reservations_changed(user_id):
+    invalidate(user_namespace(user_id))
+    invalidate('reservations')
+
+
+def conditional(*namespaces):
+    # ETag built from the namespace versions, the endpoint, the query string and the caller's role.
+    # A request whose If-None-Match holds the current tag gets 304 before the view runs.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            parts = [request.endpoint, request.query_string.decode(), str(get_jwt().get('role'))]
+            parts += [str(version) for version in current_versions(list(namespaces))]
+            etag = hashlib.sha1(':'.join(parts).encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'  # the browser keeps the copy but revalidates it
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_per_user(view):
+    # for views that return the caller's own data, placed under @jwt_required(): entries are keyed
+    # on the identity and role in the token, so one user is never served another user's response.
+    # Call invalidate(user_namespace(user_id)) when that user's reservations change.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = get_jwt_identity()
+        key = f'{request.endpoint}:{user_id}:{get_jwt().get("role")}'
+        return cached_json([user_namespace(user_id), 'parkinglots'], lambda: view(*args, **kwargs), key=key)
+    return wrapper
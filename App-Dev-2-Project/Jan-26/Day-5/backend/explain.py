@@ -0,0 +1,110 @@
+# Usage: python explain.py
+# Calls the hot endpoints against a throwaway database, runs EXPLAIN QUERY PLAN on every
+# statement they send to SQLite and exits with status 1 if any of them scans a whole table.
+import os
+import re
+import sys
+import tempfile
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'explain.db'))
+os.environ.setdefault('CACHE_TYPE', 'SimpleCache')
+
+from sqlalchemy import event
+from flask_jwt_extended import create_access_token
+from app import app
+from models import db, User
+from allocator import spot_calendar
+from revocation import revocations
+from provisioning import create_lot_with_spots
+
+# tables that are read whole on purpose: they hold one row per lot
+SMALL_TABLES = {'parking_lot', 'lot_stats'}
+
+HOT_ENDPOINTS = [
+    ('POST', '/api/user_reservation', 'user', {
+        'selected_lot': 1,
+        'vehicle_number': 'TN01AB1234',
+        'start_time': '2026-01-01T10:00',
+        'end_time': '2026-01-01T12:00'
+    }),
+    ('POST', '/api/user_reservations/batch', 'user', {
+        'selected_lot': 1,
+        'reservations': [
+            {'vehicle_number': 'TN01AB1235', 'start_time': '2026-01-01T10:00', 'end_time': '2026-01-01T12:00'},
+            {'vehicle_number': 'TN01AB1236', 'start_time': '2026-01-01T11:00', 'end_time': '2026-01-01T13:00'}
+        ]
+    }),
+    ('GET', '/api/parkinglots/1/availability?start=2026-01-01T09:00&end=2026-01-01T11:00', 'user', None),
+    ('GET', '/api/user/my_reservations', 'user', None),
+    ('GET', '/api/user/summary', 'user', None),
+    ('GET', '/api/admin/summary', 'admin', None),
+    ('GET', '/api/admin/occupancy?lot_id=1&from=2026-01-01T00:00&to=2026-01-02T00:00&bucket=hour', 'admin', None),
+    ('GET', '/api/admin/occupancy?from=2026-01-01T00:00&to=2026-01-02T00:00&bucket=day', 'admin', None),
+    ('GET', '/api/admin/reservations?limit=50&after=1', 'admin', None),
+    ('GET', '/api/get-data?limit=50&after=1', 'admin', None),
+    ('PUT', '/api/user_reservations/1/release', 'user', None),
+]
+
+
+def capture_statements(client, method, url, headers, body):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.open(url, method=method, headers=headers, json=body)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200, (method, url, response.get_json())
+    return statements
+
+
+def table_scans(statement, parameters):
+    with db.engine.connect() as conn:
+        plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if match and match.group(1) in db.metadata.tables and match.group(1) not in SMALL_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def find_full_scans(client, user_id, admin_id):
+    # [(endpoint, statement, plan line)] for every hot query that does a full table scan
+    tokens = {
+        'user': create_access_token(identity=user_id, additional_claims={'role': 'user'}),
+        'admin': create_access_token(identity=admin_id, additional_claims={'role': 'admin'}),
+    }
+    problems = []
+    for method, url, role, body in HOT_ENDPOINTS:
+        headers = {'Authorization': 'Bearer ' + tokens[role]}
+        for statement, parameters in capture_statements(client, method, url, headers, body):
+            for detail in table_scans(statement, parameters):
+                problems.append((f'{method} {url}', statement, detail))
+    return problems
+
+
+if __name__ == '__main__':
+    app.config['JWT_VERIFY_SUB'] = False  # the app issues integer identities
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(id=1, username='admin', email='admin@gmail.com', password='x', role='admin'))
+        db.session.add(User(id=2, username='user', email='user@gmail.com', password='x', role='user'))
+        create_lot_with_spots({'name': 'Lot A', 'city': 'Chennai', 'location': 'IITM', 'price': 20.0, 'total_spots': 50})
+        db.session.commit()
+        spot_calendar.load()
+        revocations.load()
+
+        problems = find_full_scans(app.test_client(), user_id=2, admin_id=1)
+
+    for endpoint, statement, detail in problems:
+        print(f'{endpoint}: {detail}\n    {" ".join(statement.split())}')
+    if problems:
+        sys.exit(1)
+    print(f'OK: no full table scans in {len(HOT_ENDPOINTS)} hot endpoints')
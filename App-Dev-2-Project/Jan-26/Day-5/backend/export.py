@@ -0,0 +1,66 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+EXPORT_CHUNK_ROWS = 1000
+
+EXPORT_COLUMNS = ['id', 'user_name', 'vehicle_number', 'lot_name', 'lot_city', 'lot_location',
+                  'spot_id', 'start_time', 'end_time', 'status', 'cost']
+
+
+def export_record(row):
+    record = {}
+    for column in EXPORT_COLUMNS:
+        value = getattr(row, column)
+        record[column] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def chunked(lines, size=EXPORT_CHUNK_ROWS):
+    # the first line is sent on its own so the response starts straight away,
+    # after that lines are joined into one write per size lines
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()  # the header goes out before the query has run
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(export_record(row).values())
+        yield buffer.getvalue()
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(export_record(row)) + '\n'
+
+
+def csv_chunks(rows):
+    return chunked(csv_lines(rows))
+
+
+def ndjson_chunks(rows):
+    return chunked(ndjson_lines(rows))
+
+
+# format -> (chunk generator, mimetype)
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
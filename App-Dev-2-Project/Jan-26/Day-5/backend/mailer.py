@@ -0,0 +1,102 @@
+import os
+import smtplib
+import threading
+import time
+
+# errors about one message; smtplib resets the transaction, so the connection can take the next one
+REFUSED = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError, smtplib.SMTPNotSupportedError)
+
+
+class SMTPPool:
+    # Logged-in SMTP connections kept open per worker process and reused across messages.
+    # A connection that has been idle for more than check_after seconds is checked with NOOP
+    # before it is handed out, and a send that hits a dropped connection is retried on a new one.
+
+    def __init__(self, host, port, username, password, size=4, check_after=30, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.check_after = check_after
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []  # [(connection, last used)]
+        self.pid = os.getpid()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.login(self.username, self.password)
+        return connection
+
+    def healthy(self, connection):
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # a forked Celery worker must not share its parent's sockets
+                self.idle, self.pid = [], os.getpid()
+            while self.idle:
+                connection, last_used = self.idle.pop()
+                if time.monotonic() - last_used < self.check_after or self.healthy(connection):
+                    return connection
+                connection.close()
+        return self.connect()
+
+    def release(self, connection):
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append((connection, time.monotonic()))
+                return
+        self.close(connection)
+
+    def send(self, message):
+        return self.send_many([message]) == 1
+
+    def send_many(self, messages):
+        # sends every message over one pooled connection, reconnecting once per message if the
+        # server drops it. A message the server refuses is skipped; once one fails on a new connection
+        # as well the server is taken to be down and the rest are not tried. Returns the number sent,
+        # so callers count the others as failed instead of losing the whole batch to one exception.
+        sent, connection = 0, None
+        try:
+            for message in messages:
+                for retry in (False, True):
+                    try:
+                        if connection is None:
+                            connection = self.connect() if retry else self.acquire()
+                        connection.send_message(message)
+                        sent += 1
+                        break
+                    except REFUSED:
+                        break
+                    except (smtplib.SMTPException, OSError):
+                        # dropped connection, unreachable server or failed login
+                        if connection is not None:
+                            connection.close()
+                            connection = None
+                        if retry:
+                            return sent
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            raise
+        if connection is not None:
+            self.release(connection)
+        return sent
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            self.close(connection)
@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 
 db = SQLAlchemy()
 
@@ -19,7 +20,7 @@ class ParkingLot(db.Model):
     location = db.Column(db.String(200), nullable=False)
     price = db.Column(db.Float, nullable=False)
     total_spots = db.Column(db.Integer, nullable=False)
-    is_deleted = db.Column(db.Boolean, default=False, nullable=False)
+    is_deleted = db.Column(db.Boolean, default=False, nullable=False, index=True)
     
     parking_spots = db.relationship('ParkingSpot', backref='parking_lot', lazy=True)
  
@@ -30,12 +31,80 @@ class ParkingSpot(db.Model):
     
     reservations = db.relationship('Reservation', backref='parking_spot', lazy=True)
 
+    __table_args__ = (db.Index('ix_parking_spot_lot_status', 'parking_lot_id', 'status'),)
+
 class Reservation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     parking_spot_id = db.Column(db.Integer, db.ForeignKey('parking_spot.id'), nullable=False)
     vehicle_number = db.Column(db.String(20), nullable=False)
-    start_time = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False, index=True)
     end_time = db.Column(db.DateTime, nullable=False)       
-    status = db.Column(db.String(20), default='active', nullable=False)  # 'active', 'completed', 'cancelled'
-    cost = db.Column(db.Float, nullable=False)
\ No newline at end of file
+    status = db.Column(db.String(20), default='active', nullable=False, index=True)  # 'active', 'completed', 'cancelled'
+    cost = db.Column(db.Float, nullable=False)
+
+    # overlap checks: active reservations on a spot that start before the end of a window
+    __table_args__ = (db.Index('ix_reservation_spot_window', 'parking_spot_id', 'status', 'start_time'),)
+
+# read models for the summary endpoints, kept in step with Reservation by summary.bump_stats
+class LotStats(db.Model):
+    __tablename__ = 'lot_stats'
+    parking_lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    reservations = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    active = db.Column(db.Integer, default=0, nullable=False)
+    completed = db.Column(db.Integer, default=0, nullable=False)
+
+class UserLotStats(db.Model):
+    __tablename__ = 'user_lot_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    parking_lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    reservations = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    active = db.Column(db.Integer, default=0, nullable=False)
+    completed = db.Column(db.Integer, default=0, nullable=False)
+
+# optional price multiplier per hour of day, read by pricing.quote; a lot with no rows is charged its flat price
+class LotHourlyRate(db.Model):
+    __tablename__ = 'lot_hourly_rate'
+    parking_lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)  # 0-23
+    multiplier = db.Column(db.Float, default=1.0, nullable=False)
+
+# spot-hours occupied and revenue per lot per hour, added to by summary.record_occupancy when a reservation completes
+class LotOccupancy(db.Model):
+    __tablename__ = 'lot_occupancy'
+    parking_lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True, index=True)  # start of the hour
+    spot_hours = db.Column(db.Float, default=0.0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+
+# per-month totals for the monthly report, added to by summary.roll_up_months for reservations past the watermark
+class MonthlyRollup(db.Model):
+    __tablename__ = 'monthly_rollup'
+    period = db.Column(db.String(7), primary_key=True)  # 'YYYY-MM' of start_time
+    parking_lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    reservations = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+
+class ReportWatermark(db.Model):
+    __tablename__ = 'report_watermark'
+    name = db.Column(db.String(40), primary_key=True)
+    last_reservation_id = db.Column(db.Integer, default=0, nullable=False)
+
+# jti of logged out tokens, loaded into revocation.revocations' Bloom filter
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_token'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires = db.Column(db.Integer, nullable=False, index=True)  # the token's exp, seconds since the epoch
+
+def create_indexes():
+    # create_all() skips tables that already exist, so add any missing index to an existing database.
+    # Returns the names of the tables that did not exist yet
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    return set(db.metadata.tables) - existing
@@ -0,0 +1,23 @@
+from flask import request, jsonify
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def keyset_page(query, id_column, to_json):
+    # ?limit=&after= returns {'data': [...], 'next_cursor': id or None}, reading rows with id > after
+    # through the primary key, so every page costs the same however deep it is.
+    # Without either parameter the whole list is returned as a plain array, as the Vue admin pages expect.
+    # query must already be ordered by id_column.
+    if 'limit' not in request.args and 'after' not in request.args:
+        return jsonify([to_json(row) for row in query.all()])
+
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after = request.args.get('after', 0, type=int)
+    rows = query.filter(id_column > after).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return jsonify({'data': [to_json(row) for row in rows], 'next_cursor': next_cursor})
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+QUEUED_PER_WORKER = 8
+
+
+class HashingBusy(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def method_prefix(method):
+    # what a hash made with method starts with, e.g. 'pbkdf2' -> 'pbkdf2:sha256:1000000'
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+class PasswordHasher:
+    # Runs werkzeug's hashing on PASSWORD_HASH_WORKERS threads. hashlib's scrypt and pbkdf2 release the GIL
+    # while they work, so at most that many hashes use the CPU at once and the other request threads keep running.
+    # A login storm queues at most QUEUED_PER_WORKER calls per worker; past that HashingBusy is raised
+    # (503 from the app) instead of piling up behind the pool.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.slots = None
+        self.workers = None
+        self.pid = None
+
+    def pool(self):
+        workers = current_app.config['PASSWORD_HASH_WORKERS']
+        with self.lock:
+            if self.pid != os.getpid() or self.workers != workers:
+                # a forked worker process needs threads of its own
+                if self.executor and self.pid == os.getpid():
+                    self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+                self.slots = threading.BoundedSemaphore(workers * QUEUED_PER_WORKER)
+                self.workers, self.pid = workers, os.getpid()
+            return self.executor, self.slots
+
+    def run(self, function, *args):
+        executor, slots = self.pool()
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return executor.submit(function, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, stored_hash, password):
+        # (matches, new hash or None); the new hash is set when stored_hash was made with another method
+        # than PASSWORD_HASH_METHOD, and the caller saves it so the policy change reaches every user on their next login
+        if not self.run(check_password_hash, stored_hash, password):
+            return False, None
+        if stored_hash.split('$', 1)[0] == method_prefix(current_app.config['PASSWORD_HASH_METHOD']):
+            return True, None
+        return True, self.hash(password)
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,66 @@
+import numpy as np
+from models import db, ParkingLot, LotHourlyRate
+
+MAX_QUOTES = 10000
+HOURS_PER_DAY = 24
+
+
+def rate_tables(lot_ids):
+    # {lot id: (price, 24 multipliers by hour of day)} for the lots that exist and are not deleted,
+    # in two queries; an hour with no LotHourlyRate row is charged the flat price
+    lots = {
+        lot_id: (price, np.ones(HOURS_PER_DAY))
+        for lot_id, price in db.session.query(ParkingLot.id, ParkingLot.price).filter(
+            ParkingLot.id.in_(lot_ids), ParkingLot.is_deleted == False
+        )
+    }
+    rates = db.session.query(LotHourlyRate.parking_lot_id, LotHourlyRate.hour, LotHourlyRate.multiplier).filter(
+        LotHourlyRate.parking_lot_id.in_(list(lots))
+    )
+    for lot_id, hour, multiplier in rates:
+        lots[lot_id][1][hour] = multiplier
+    return lots
+
+
+def quote(lot_ids, starts, ends):
+    # costs for parallel arrays of lot ids and datetime64[m] windows, all in one vectorized pass.
+    # The price is charged per hour times that hour of day's multiplier, so cost is
+    # price * (rated_hours(end) - rated_hours(start)) where rated_hours integrates the multipliers from the epoch.
+    # NaN where the lot does not exist or the window is empty
+    lot_ids = np.asarray(lot_ids)
+    unique_ids, index = np.unique(lot_ids, return_inverse=True)
+    tables = rate_tables(unique_ids.tolist())
+    prices = np.array([tables[lot_id][0] if lot_id in tables else np.nan for lot_id in unique_ids.tolist()])
+    multipliers = np.ones((len(unique_ids), HOURS_PER_DAY))
+    for i, lot_id in enumerate(unique_ids.tolist()):
+        if lot_id in tables:
+            multipliers[i] = tables[lot_id][1]
+    # cumulative[lot, h] is the rated hours from midnight to hour h
+    cumulative = np.zeros((len(unique_ids), HOURS_PER_DAY + 1))
+    np.cumsum(multipliers, axis=1, out=cumulative[:, 1:])
+
+    def rated_hours(times):
+        hours = (times - np.datetime64(0, 'm')).astype(np.int64) / 60.0
+        days, hour_of_day = np.divmod(hours, HOURS_PER_DAY)
+        whole = hour_of_day.astype(np.int64)
+        return (days * cumulative[index, HOURS_PER_DAY] + cumulative[index, whole]
+                + multipliers[index, whole] * (hour_of_day - whole))
+
+    costs = np.round(prices[index] * (rated_hours(ends) - rated_hours(starts)), 2)
+    costs[ends <= starts] = np.nan
+    return costs
+
+
+def booking_cost(lot_id, start, end):
+    # one quote, so a booking always costs what /api/quotes said it would
+    cost = quote([lot_id], np.array([start], dtype='datetime64[m]'), np.array([end], dtype='datetime64[m]'))[0]
+    return None if np.isnan(cost) else float(cost)
+
+
+def set_rate_table(lot_id, multipliers):
+    # replaces the lot's table; an empty list goes back to the flat price
+    db.session.query(LotHourlyRate).filter(LotHourlyRate.parking_lot_id == lot_id).delete()
+    db.session.add_all(
+        LotHourlyRate(parking_lot_id=lot_id, hour=hour, multiplier=multiplier)
+        for hour, multiplier in enumerate(multipliers) if multiplier != 1
+    )
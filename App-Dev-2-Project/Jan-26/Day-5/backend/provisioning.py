@@ -0,0 +1,45 @@
+from sqlalchemy import insert
+from models import db, ParkingLot, ParkingSpot
+
+LOT_TEXT_FIELDS = {'name': 100, 'city': 100, 'location': 200}  # column lengths on ParkingLot
+
+
+def add_spots(parking_lot_id, count):
+    # one executemany INSERT for every spot instead of one commit per spot
+    rows = [{'parking_lot_id': parking_lot_id, 'status': 'available'}] * count
+    if rows:
+        db.session.execute(insert(ParkingSpot), rows)
+
+
+def create_lot_with_spots(data):
+    parkinglot = ParkingLot(
+        name=data['name'],
+        city=data['city'],
+        location=data['location'],
+        price=data['price'],
+        total_spots=data['total_spots']
+    )
+    db.session.add(parkinglot)
+    db.session.flush()  # assigns parkinglot.id without committing
+
+    add_spots(parkinglot.id, parkinglot.total_spots)
+    return parkinglot
+
+
+def lot_error(data):
+    # what is wrong with one lot of an import, or None; checked before anything is written
+    if not isinstance(data, dict):
+        return 'must be an object'
+    for field, length in LOT_TEXT_FIELDS.items():
+        if not isinstance(data.get(field), str) or not 0 < len(data[field].strip()) <= length:
+            return f'{field} is required, at most {length} characters'
+    if type(data.get('price')) not in (int, float) or not 0 <= data['price'] < float('inf'):
+        return 'price must be a non-negative number'
+    if type(data.get('total_spots')) is not int or data['total_spots'] < 0:
+        return 'total_spots must be a non-negative integer'
+    return None
+
+
+def import_lots(lots):
+    # caller commits, so a whole import is a single transaction
+    return [create_lot_with_spots(lot) for lot in lots]
@@ -0,0 +1,107 @@
+import hashlib
+import math
+import threading
+import time
+from sqlalchemy import func, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, RevokedToken
+
+
+class BloomFilter:
+    # set membership in size bits: "not in" is always right, "in" is wrong about error_rate of the time
+    # while no more than capacity keys have been added
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # k positions from one 128-bit hash (double hashing)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class RevocationList:
+    # The jti of every revoked token that has not expired, in a Bloom filter per process. A jti the filter has never
+    # seen is answered in microseconds without the database; a hit (revoked, or a false positive about error_rate
+    # of the time) is confirmed with one lookup on the jti index. Revocations made by other processes are picked
+    # up every refresh_every seconds by reading the rows added since the last id seen.
+
+    def __init__(self, capacity=100000, error_rate=0.001, refresh_every=5):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_every = refresh_every
+        self.lock = threading.Lock()
+        self.filter = None
+        self.last_id = 0
+        self.refreshed_at = None
+
+    def load(self):
+        # rebuild from the table, sized for twice the live revocations so it does not fill up straight away
+        now = int(time.time())
+        live = db.session.query(func.count(RevokedToken.id)).filter(RevokedToken.expires > now).scalar()
+        bloom = BloomFilter(max(self.capacity, 2 * live), self.error_rate)
+        for (jti,) in db.session.query(RevokedToken.jti).filter(RevokedToken.expires > now).yield_per(10000):
+            bloom.add(jti)
+        last_id = db.session.query(func.max(RevokedToken.id)).scalar() or 0
+        with self.lock:
+            self.filter, self.last_id, self.refreshed_at = bloom, last_id, time.monotonic()
+
+    def refresh_if_due(self):
+        if self.filter is None:
+            self.load()
+        elif time.monotonic() - self.refreshed_at >= self.refresh_every:
+            self.refresh()
+
+    def refresh(self):
+        # adds the rows written since the last id seen, by this process or another. Read under the lock so that
+        # two threads refreshing at once do not both add the same rows
+        with self.lock:
+            rows = db.session.query(RevokedToken.id, RevokedToken.jti).filter(RevokedToken.id > self.last_id).all()
+            for row_id, jti in rows:
+                self.filter.add(jti)
+                self.last_id = max(self.last_id, row_id)
+            self.refreshed_at = time.monotonic()
+        if self.filter.count > self.filter.capacity:
+            self.load()  # past capacity the false positive rate climbs
+
+    def is_revoked(self, jti):
+        self.refresh_if_due()
+        if jti not in self.filter:
+            return False
+        return db.session.query(RevokedToken.id).filter(RevokedToken.jti == jti).first() is not None
+
+    def revoke(self, jti, expires):
+        # expires is the token's exp claim; the row can be pruned after that since the token is dead anyway.
+        # The new row reaches the filter through refresh() like any other, which moves last_id past it,
+        # so the jti is added (and counted towards capacity) once
+        stmt = sqlite_insert(RevokedToken).values(jti=jti, expires=expires).on_conflict_do_nothing(index_elements=['jti'])
+        db.session.execute(stmt)
+        db.session.commit()
+        if self.filter is None:
+            self.load()
+        else:
+            self.refresh()
+
+    def prune(self):
+        # drop the rows of expired tokens and rebuild the filter without them; returns how many were removed
+        removed = db.session.execute(delete(RevokedToken).where(RevokedToken.expires <= int(time.time()))).rowcount
+        db.session.commit()
+        self.load()
+        return removed
+
+
+revocations = RevocationList()
@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func, case, insert, delete, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, ParkingLot, ParkingSpot, Reservation, LotStats, UserLotStats, MonthlyRollup, ReportWatermark, LotOccupancy
+
+COUNTERS = ('reservations', 'revenue', 'active', 'completed')
+ROLLUP_WATERMARK = 'monthly_rollup'
+BACKFILL_CHUNK_ROWS = 10000
+
+
+def bump_stats(parking_lot_id, user_id, reservations=0, revenue=0.0, active=0, completed=0):
+    # upsert both read models in the caller's transaction; the caller commits
+    deltas = {'reservations': reservations, 'revenue': revenue, 'active': active, 'completed': completed}
+    for model, keys in (
+        (LotStats, {'parking_lot_id': parking_lot_id}),
+        (UserLotStats, {'user_id': user_id, 'parking_lot_id': parking_lot_id}),
+    ):
+        stmt = sqlite_insert(model).values(**keys, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in COUNTERS}
+        )
+        db.session.execute(stmt)
+
+
+def reservation_booked(parking_lot_id, reservation):
+    bump_stats(parking_lot_id, reservation.user_id, reservations=1, revenue=reservation.cost, active=1)
+
+
+def reservations_booked(parking_lot_id, user_id, reservations):
+    # one stats upsert for a batch of one user's bookings on one lot
+    bump_stats(parking_lot_id, user_id, reservations=len(reservations),
+               revenue=sum(reservation.cost for reservation in reservations), active=len(reservations))
+
+
+def reservation_released(parking_lot_id, reservation):
+    bump_stats(parking_lot_id, reservation.user_id, active=-1, completed=1)
+    record_occupancy({(parking_lot_id, hour): usage for hour, usage in hourly_usage(reservation.start_time, reservation.end_time, reservation.cost)})
+
+
+def rebuild_lot_stats():
+    # regenerate both read models from the Reservation table in one transaction
+    db.session.execute(delete(LotStats))
+    db.session.execute(delete(UserLotStats))
+
+    for model, group_by in (
+        (LotStats, [ParkingSpot.parking_lot_id]),
+        (UserLotStats, [Reservation.user_id, ParkingSpot.parking_lot_id]),
+    ):
+        query = db.session.query(
+            *group_by,
+            func.count(Reservation.id),
+            func.sum(Reservation.cost),
+            func.sum(case((Reservation.status == 'active', 1), else_=0)),
+            func.sum(case((Reservation.status == 'completed', 1), else_=0))
+        ).join(ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id).group_by(*group_by)
+        columns = [column.key for column in group_by] + list(COUNTERS)
+        db.session.execute(insert(model).from_select(columns, query.statement))
+
+    db.session.commit()
+
+
+def lot_totals(user_id=None):
+    # reservation count and cost per lot name, read from the stats table (one row per lot)
+    model = LotStats if user_id is None else UserLotStats
+    query = db.session.query(
+        ParkingLot.name,
+        func.sum(model.reservations),
+        func.sum(model.revenue)
+    ).join(ParkingLot, model.parking_lot_id == ParkingLot.id)
+    if user_id is not None:
+        query = query.filter(UserLotStats.user_id == user_id)
+    rows = query.filter(model.reservations > 0).group_by(ParkingLot.name).order_by(func.min(ParkingLot.id)).all()
+
+    lot_names = [row[0] for row in rows]
+    lot_counts = [row[1] for row in rows]
+    lot_costs = [row[2] for row in rows]
+    return lot_names, lot_counts, lot_costs
+
+
+def status_counts(user_id=None):
+    model = LotStats if user_id is None else UserLotStats
+    query = db.session.query(func.sum(model.active), func.sum(model.completed))
+    if user_id is not None:
+        query = query.filter(UserLotStats.user_id == user_id)
+    active, completed = query.one()
+    return {'active': active or 0, 'completed': completed or 0}
+
+
+def roll_up_months():
+    # adds the reservations created since the last run to their month's MonthlyRollup row and moves
+    # the watermark past them in the same transaction, so earlier rows are never read again.
+    # Returns the number of reservations rolled up.
+    db.session.execute(sqlite_insert(ReportWatermark).values(name=ROLLUP_WATERMARK, last_reservation_id=0).on_conflict_do_nothing())
+    last = db.session.query(ReportWatermark.last_reservation_id).filter_by(name=ROLLUP_WATERMARK).scalar()
+    high = db.session.query(func.max(Reservation.id)).scalar() or 0
+    if high <= last:
+        db.session.commit()
+        return 0
+
+    moved = db.session.execute(
+        update(ReportWatermark)
+        .where(ReportWatermark.name == ROLLUP_WATERMARK, ReportWatermark.last_reservation_id == last)
+        .values(last_reservation_id=high)
+    ).rowcount
+    if not moved:
+        db.session.rollback()  # another run has rolled these up already
+        return 0
+
+    period = func.strftime('%Y-%m', Reservation.start_time)
+    query = db.session.query(
+        period, ParkingSpot.parking_lot_id, func.count(Reservation.id), func.sum(Reservation.cost)
+    ).join(ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id
+    ).filter(Reservation.id > last, Reservation.id <= high
+    ).group_by(period, ParkingSpot.parking_lot_id)
+    stmt = sqlite_insert(MonthlyRollup).from_select(['period', 'parking_lot_id', 'reservations', 'revenue'], query.statement)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['period', 'parking_lot_id'],
+        set_={name: getattr(MonthlyRollup, name) + getattr(stmt.excluded, name) for name in ('reservations', 'revenue')}
+    )
+    rolled = db.session.query(func.count(Reservation.id)).filter(Reservation.id > last, Reservation.id <= high).scalar()
+    db.session.execute(stmt)
+    db.session.commit()
+    return rolled
+
+
+def period_bounds(period):
+    # 'YYYY-MM' -> [first instant of the month, first instant of the next month)
+    start = datetime.strptime(period, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+
+def month_rollups(period):
+    # [(lot name, reservations, revenue)] for one month, read from MonthlyRollup
+    return db.session.query(ParkingLot.name, MonthlyRollup.reservations, MonthlyRollup.revenue).join(
+        ParkingLot, MonthlyRollup.parking_lot_id == ParkingLot.id
+    ).filter(MonthlyRollup.period == period).order_by(ParkingLot.id).all()
+
+
+def period_totals(before=None, limit=12):
+    # [(period, reservations, revenue)] for the latest months, newest first; only the months before
+    # the 'YYYY-MM' period before when it is given
+    query = db.session.query(MonthlyRollup.period, func.sum(MonthlyRollup.reservations), func.sum(MonthlyRollup.revenue))
+    if before is not None:
+        query = query.filter(MonthlyRollup.period < before)
+    return query.group_by(MonthlyRollup.period).order_by(MonthlyRollup.period.desc()).limit(limit).all()
+
+
+def hourly_usage(start, end, cost):
+    # [(start of hour, (spot-hours, revenue))] for every hour the window touches, revenue split by time
+    usage = []
+    total = (end - start).total_seconds()
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        seconds = (min(end, hour + timedelta(hours=1)) - max(start, hour)).total_seconds()
+        usage.append((hour, (seconds / 3600, cost * seconds / total if total else 0.0)))
+        hour += timedelta(hours=1)
+    return usage
+
+
+def record_occupancy(usage):
+    # usage: {(parking_lot_id, hour): (spot-hours, revenue)}, upserted with one executemany in the caller's transaction
+    if not usage:
+        return
+    stmt = sqlite_insert(LotOccupancy)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['parking_lot_id', 'hour'],
+        set_={name: getattr(LotOccupancy, name) + getattr(stmt.excluded, name) for name in ('spot_hours', 'revenue')}
+    )
+    db.session.execute(stmt, [
+        {'parking_lot_id': lot_id, 'hour': hour, 'spot_hours': spot_hours, 'revenue': revenue}
+        for (lot_id, hour), (spot_hours, revenue) in usage.items()
+    ])
+
+
+def rebuild_occupancy():
+    # replays every completed reservation into lot_occupancy, BACKFILL_CHUNK_ROWS at a time
+    db.session.execute(delete(LotOccupancy))
+    rows = db.session.query(ParkingSpot.parking_lot_id, Reservation.start_time, Reservation.end_time, Reservation.cost).join(
+        ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id
+    ).filter(Reservation.status == 'completed')
+    usage = {}
+    for count, (lot_id, start, end, cost) in enumerate(rows.yield_per(BACKFILL_CHUNK_ROWS), 1):
+        for hour, (spot_hours, revenue) in hourly_usage(start, end, cost):
+            previous = usage.get((lot_id, hour), (0.0, 0.0))
+            usage[(lot_id, hour)] = (previous[0] + spot_hours, previous[1] + revenue)
+        if count % BACKFILL_CHUNK_ROWS == 0:
+            record_occupancy(usage)
+            usage = {}
+    record_occupancy(usage)
+    db.session.commit()
+
+
+def occupancy_series(start, end, parking_lot_id=None, bucket='hour'):
+    # [(bucket start, spot-hours, revenue)] between start and end from lot_occupancy; empty buckets are left out.
+    # start is moved back to the start of its bucket so the first bucket is whole. Without a lot, only the lots
+    # that are not deleted are added up, the same ones the caller counts the capacity of
+    if bucket == 'day':
+        period = func.strftime('%Y-%m-%d 00:00:00', LotOccupancy.hour)
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        period = func.strftime('%Y-%m-%d %H:00:00', LotOccupancy.hour)
+        start = start.replace(minute=0, second=0, microsecond=0)
+    query = db.session.query(period, func.sum(LotOccupancy.spot_hours), func.sum(LotOccupancy.revenue)).filter(
+        LotOccupancy.hour >= start, LotOccupancy.hour < end
+    )
+    if parking_lot_id is not None:
+        query = query.filter(LotOccupancy.parking_lot_id == parking_lot_id)
+    else:
+        query = query.join(ParkingLot, LotOccupancy.parking_lot_id == ParkingLot.id).filter(ParkingLot.is_deleted == False)
+    rows = query.group_by(period).order_by(period).all()
+    return [(datetime.strptime(time, '%Y-%m-%d %H:%M:%S'), spot_hours, revenue) for time, spot_hours, revenue in rows]
@@ -1,18 +1,34 @@
 from celery_worker import celery_app
+from celery import chord
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart 
 from email.mime.text import MIMEText
-import smtplib 
-from flask import render_template
-from models import User, Reservation, ParkingLot, ParkingSpot
+import tempfile
+from datetime import datetime
+from itertools import groupby
+from flask import stream_template, current_app
+from sqlalchemy import func
+from models import db, User, Reservation, ParkingSpot, ParkingLot
+from app import reservation_export_rows
+from export import csv_chunks
+from mailer import SMTPPool
+from summary import roll_up_months, period_bounds, month_rollups, period_totals
 
 SERVER_SMTP_HOST = 'localhost'
 SERVER_SMTP_PORT = 1025
 SENDER_ADDRESS='shrikrishna@gmail.com'
 SENDER_PASSWORD=''
 
-def send_email(to_address,subject,message,content="text",attachment=None):
+REPORT_CHUNK_ROWS = 1000
+SPOOL_MAX_BYTES = 1024 * 1024  # reports bigger than this are written to disk instead of kept in memory
+REMINDER_CHUNK_SIZE = 500
+REMINDER_CHUNK_RATE_LIMIT = '30/m'  # chunks started per minute by each worker, keeps the SMTP server from being flooded
+REMINDER_DIGEST = True  # one mail per user listing all their vehicles instead of one per reservation
+
+mailer = SMTPPool(SERVER_SMTP_HOST, SERVER_SMTP_PORT, SENDER_ADDRESS, SENDER_PASSWORD)
+
+def build_email(to_address,subject,message,content="text",attachments=()):
     msg = MIMEMultipart()
     msg['To']=to_address
     msg['From']=SENDER_ADDRESS
@@ -22,72 +38,146 @@ def send_email(to_address,subject,message,content="text",attachment=None):
     else:
         msg.attach(MIMEText(message, 'plain'))
 
-    if attachment:
-        with open(attachment,"rb") as a:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(a.read())
+    for filename, file in attachments:
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(file.read())
         encoders.encode_base64(part)
-        part.add_header("Content-Disposition", f"attachment: filename={attachment}")
-        msg.attach(part)          
+        part.add_header("Content-Disposition", f"attachment; filename={filename}")
+        msg.attach(part)
+    return msg
+
+def send_email(to_address,subject,message,content="text",attachments=()):
+    return mailer.send(build_email(to_address, subject, message, content, attachments))
+
+def send_emails(emails):
+    # emails: (to_address, subject, message) tuples, all sent over one pooled connection
+    return mailer.send_many(build_email(*email) for email in emails)
 
-    s = smtplib.SMTP(host=SERVER_SMTP_HOST, port=SERVER_SMTP_PORT )
-    s.login(SENDER_ADDRESS,SENDER_PASSWORD)
-    s.send_message(msg)
-    s.quit()
-    return True
+def spool(chunks):
+    # writes text chunks to a temp file that stays in memory up to SPOOL_MAX_BYTES and moves to disk after that
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    for chunk in chunks:
+        file.write(chunk.encode())
+    file.seek(0)
+    return file
+
+def report_rows(query):
+    # one dict at a time for the templates, fetched REPORT_CHUNK_ROWS rows at a time
+    for row in query.yield_per(REPORT_CHUNK_ROWS):
+        yield {
+            'username': row.user_name,
+            'vehicle_number': row.vehicle_number,
+            'parking_lot': row.lot_name,
+            'status': row.status,
+            'start_time': row.start_time,
+            'end_time': row.end_time,
+            'cost': row.cost
+        }
 
 @celery_app.task
-def send_monthly_report():
+def send_monthly_report(period=None):
+    # period is 'YYYY-MM', the current month by default. Totals come from the monthly rollups,
+    # which only take in reservations created since the last run; the detail list reads
+    # just that month's rows through the start_time index.
     admin = User.query.filter_by(role='admin').first()
     if not admin:
         return "No admin user found"
-    reservation = Reservation.query.all()
-    reservation_data = []
-    for res in reservation:
-        user = User.query.get(res.user_id)
-        parking_spot = ParkingSpot.query.get(res.parking_spot_id)
-        parking_lot = ParkingLot.query.get(parking_spot.parking_lot_id)
-        reservation_data.append({
-            'username': user.username,
-            'vehicle_number': res.vehicle_number,
-            'parking_lot': parking_lot.name,
-            'status': res.status,
-            'cost': res.cost
-        })
-    html = render_template('monthly_report.html', reservations=reservation_data)
-    send_email(admin.email, "Monthly Report", html, content="html")
-    
-    # Logic to generate report and send email
-    return "Monthly report sent to admin."
+    roll_up_months()
+    period = period or datetime.now().strftime('%Y-%m')
+    start, end = period_bounds(period)
+    rows = reservation_export_rows().filter(
+        Reservation.start_time >= start, Reservation.start_time < end
+    ).order_by(None).order_by(Reservation.start_time, Reservation.id)
+    # stream_template renders with Jinja's generate(), so the page is written out row by row
+    report = spool(stream_template('monthly_report.html', period=period, lots=month_rollups(period),
+                                   history=period_totals(period), reservations=report_rows(rows)))
+    with report:
+        sent = send_email(admin.email, f"Monthly Report {period}", f"Hello Admin,\nThe report of the reservations for {period} is attached.",
+                          attachments=[(f'monthly_report_{period}.html', report)])
+    return f"Monthly report for {period} sent to admin." if sent else f"Monthly report for {period} could not be delivered."
     
+def id_ranges(query, id_column, size):
+    # [(after_id, last_id)] ranges holding up to size rows of query each, found with one index seek per range
+    ranges, after = [], 0
+    while True:
+        last = query.filter(id_column > after).order_by(id_column).offset(size - 1).limit(1).scalar()
+        if last is None:
+            last = query.filter(id_column > after).with_entities(func.max(id_column)).scalar()
+            if last is not None:
+                ranges.append((after, last))
+            return ranges
+        ranges.append((after, last))
+        after = last
+
+def active_id_ranges(size):
+    return id_ranges(db.session.query(Reservation.id).filter(Reservation.status == 'active'), Reservation.id, size)
+
+def user_id_ranges(size):
+    return id_ranges(db.session.query(User.id), User.id, size)
+
 @celery_app.task
-def send_daily_reminder():  
-    active_reservations = Reservation.query.filter_by(status='active').all()
-    for res in active_reservations:
-        user = User.query.get(res.user_id)
-        send_email(user.email, "Daily Reminder", f"Dear {user.username}, you have an active reservation for your vehicle {res.vehicle_number}. Please remember to complete it on time.") 
-    # Logic to generate reminder and send email
-    return "Daily reminder sent to users with active reservations"
+def send_daily_reminder(digest=None):  
+    # coordinator: every id range goes to its own subtask so the chunks are sent in parallel
+    # by all workers, and summarize_reminders collects the results
+    if digest is None:
+        digest = REMINDER_DIGEST
+    if digest:
+        ranges, chunk_task = user_id_ranges(REMINDER_CHUNK_SIZE), send_digest_chunk
+    else:
+        ranges, chunk_task = active_id_ranges(REMINDER_CHUNK_SIZE), send_reminder_chunk
+    if not ranges:
+        return summarize_reminders([])
+    chord(chunk_task.s(after, last) for after, last in ranges)(summarize_reminders.s())
+    return f"Daily reminders dispatched in {len(ranges)} chunks"
+
+@celery_app.task(rate_limit=REMINDER_CHUNK_RATE_LIMIT)
+def send_reminder_chunk(after_id, last_id):
+    rows = db.session.query(Reservation.vehicle_number, User.email, User.username).join(
+        User, Reservation.user_id == User.id
+    ).filter(Reservation.status == 'active', Reservation.id > after_id, Reservation.id <= last_id)
+    emails = [(email, "Daily Reminder", f"Dear {username}, you have an active reservation for your vehicle {vehicle_number}. Please remember to complete it on time.")
+              for vehicle_number, email, username in rows]
+    sent = send_emails(emails)
+    return {'reservations': len(emails), 'sent': sent, 'failed': len(emails) - sent}
+
+@celery_app.task(rate_limit=REMINDER_CHUNK_RATE_LIMIT)
+def send_digest_chunk(after_user_id, last_user_id):
+    # every active reservation of the users in the range, in one query ordered by user,
+    # turned into one mail per user
+    rows = db.session.query(User.email, User.username, Reservation.vehicle_number, ParkingLot.name).join(
+        Reservation, Reservation.user_id == User.id
+    ).join(ParkingSpot, Reservation.parking_spot_id == ParkingSpot.id
+    ).join(ParkingLot, ParkingSpot.parking_lot_id == ParkingLot.id
+    ).filter(Reservation.status == 'active', Reservation.user_id > after_user_id, Reservation.user_id <= last_user_id
+    ).order_by(Reservation.user_id, Reservation.id)
+    emails, reservations = [], 0
+    for (email, username), vehicles in groupby(rows, key=lambda row: (row.email, row.username)):
+        lines = [f"- {row.vehicle_number} at {row.name}" for row in vehicles]
+        reservations += len(lines)
+        emails.append((email, "Daily Reminder", f"Dear {username}, you have {len(lines)} active reservation(s). Please remember to complete them on time.\n\n" + "\n".join(lines)))
+    sent = send_emails(emails)
+    return {'reservations': reservations, 'sent': sent, 'failed': len(emails) - sent}
+
+@celery_app.task
+def summarize_reminders(results):
+    summary = {key: sum(result[key] for result in results) for key in ('reservations', 'sent', 'failed')}
+    summary['chunks'] = len(results)
+    if summary['failed']:
+        current_app.logger.warning('daily reminders: %(failed)s of %(reservations)s not delivered', summary)
+    return summary
     
 @celery_app.task
 def export_reservations_report(user_id):
-        user = User.query.get(user_id)
-        reservations = Reservation.query.filter_by(user_id=user_id).all()
-        reservation_data = []
-        for res in reservations:
-            parking_spot = ParkingSpot.query.get(res.parking_spot_id)
-            parking_lot = ParkingLot.query.get(parking_spot.parking_lot_id)
-            reservation_data.append({
-                'vehicle_number': res.vehicle_number,
-                'parking_lot': parking_lot.name,
-                'status': res.status,
-                'start_time': res.start_time,
-                'end_time': res.end_time,
-                'cost': res.cost
-            })
-        html = render_template('export.html', reservations=reservation_data, username=user.username, total_reservations=len(reservation_data), total_cost=sum(res['cost'] for res in reservation_data))    
-        
-        send_email(user.email, "Your Reservations Report", html, content="html")
-        return "Reservations report sent to user."
-            
-        
+    user = db.session.get(User, user_id)
+    rows = reservation_export_rows().filter(Reservation.user_id == user_id)
+    total_reservations, total_cost = db.session.query(
+        func.count(Reservation.id), func.coalesce(func.sum(Reservation.cost), 0)
+    ).filter(Reservation.user_id == user_id).one()
+
+    html = spool(stream_template('export.html', reservations=report_rows(rows), username=user.username,
+                                 total_reservations=total_reservations, total_cost=total_cost))
+    csv_file = spool(csv_chunks(rows.yield_per(REPORT_CHUNK_ROWS)))
+    with html, csv_file:
+        sent = send_email(user.email, "Your Reservations Report", f"Dear {user.username}, your reservations report is attached.",
+                          attachments=[('reservations.html', html), ('reservations.csv', csv_file)])
+    return "Reservations report sent to user." if sent else "Reservations report could not be delivered."
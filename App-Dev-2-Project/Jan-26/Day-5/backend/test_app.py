@@ -0,0 +1,816 @@
+import os
+import json
+import socket
+import tempfile
+# a file rather than :memory: so that threads get their own connections
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['CACHE_TYPE'] = 'SimpleCache'
+
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+import pytest
+from sqlalchemy import event
+from flask_jwt_extended import create_access_token
+from app import app
+from models import db, User, ParkingSpot, Reservation
+from provisioning import create_lot_with_spots
+from summary import rebuild_lot_stats
+from allocator import spot_calendar
+from explain import find_full_scans
+from caching import cache
+from revocation import revocations
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    app.config['JWT_VERIFY_SUB'] = False  # the app issues integer identities
+
+    with app.app_context():
+        cache.clear()
+        db.create_all()
+        db.session.add(User(id=1, username='admin', email='admin@gmail.com', password='x', role='admin'))
+        db.session.add(User(id=2, username='alice', email='alice@gmail.com', password='x', role='user'))
+        create_lot_with_spots({'name': 'Lot A', 'city': 'Chennai', 'location': 'IITM', 'price': 20.0, 'total_spots': 100})
+        db.session.commit()
+        spot_calendar.load()
+        revocations.load()
+        with app.test_client() as client:
+            yield client
+        db.session.remove()
+        db.drop_all()
+
+
+def auth(user_id, role):
+    with app.app_context():
+        token = create_access_token(identity=user_id, additional_claims={'role': role})
+    return {'Authorization': f'Bearer {token}'}
+
+
+def add_reservations(count, user_id=2):
+    spots = ParkingSpot.query.limit(count).all()
+    for spot in spots:
+        db.session.add(Reservation(
+            user_id=user_id,
+            parking_spot_id=spot.id,
+            vehicle_number=f'TN01{spot.id:04d}',
+            start_time=datetime(2026, 1, 1, 10, 0),
+            end_time=datetime(2026, 1, 1, 12, 0),
+            status='active',
+            cost=40.0
+        ))
+    db.session.commit()
+
+
+def book(client, headers, vehicle_number):
+    return client.post('/api/user_reservation', headers=headers, json={
+        'selected_lot': 1,
+        'vehicle_number': vehicle_number,
+        'start_time': '2026-01-01T10:00',
+        'end_time': '2026-01-01T13:00'
+    })
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_my_reservations_shape(client):
+    add_reservations(1)
+    response = client.get('/api/user/my_reservations', headers=auth(2, 'user'))
+    assert response.status_code == 200
+    assert response.get_json() == [{
+        'id': 1,
+        'vehicle_number': 'TN010001',
+        'start_time': '2026-01-01T10:00:00',
+        'end_time': '2026-01-01T12:00:00',
+        'status': 'active',
+        'cost': 40.0,
+        'parking_lot': {'id': 1, 'name': 'Lot A', 'city': 'Chennai', 'location': 'IITM', 'price': 20.0}
+    }]
+
+
+def test_admin_reservations_shape(client):
+    add_reservations(1)
+    response = client.get('/api/admin/reservations', headers=auth(1, 'admin'))
+    assert response.status_code == 200
+    row = response.get_json()[0]
+    assert row['user_name'] == 'alice'
+    assert row['spot_number'] == 1
+    assert row['parking_lot']['name'] == 'Lot A'
+
+
+@pytest.mark.parametrize('url,user_id,role', [
+    ('/api/user/my_reservations', 2, 'user'),
+    ('/api/admin/reservations', 1, 'admin'),
+])
+def test_reservation_listing_query_count_is_constant(client, url, user_id, role):
+    headers = auth(user_id, role)
+
+    add_reservations(1)
+    cache.clear()  # measure the uncached path
+    with count_queries() as few:
+        assert len(client.get(url, headers=headers).get_json()) == 1
+
+    add_reservations(50)
+    cache.clear()
+    with count_queries() as many:
+        assert len(client.get(url, headers=headers).get_json()) == 51
+
+    assert len(many) == len(few)
+
+
+def test_summaries_are_aggregated(client):
+    add_reservations(3)
+    reservation = db.session.get(Reservation, 1)
+    reservation.status = 'completed'
+    db.session.commit()
+    rebuild_lot_stats()
+
+    user = client.get('/api/user/summary', headers=auth(2, 'user')).get_json()
+    assert user == {
+        'lot_names': ['Lot A'],
+        'lot_counts': [3],
+        'lot_costs': [120.0],
+        'total_spent': 120.0,
+        'active_reservations': 2,
+        'completed_reservations': 1,
+        'total': 3
+    }
+
+    admin = client.get('/api/admin/summary', headers=auth(1, 'admin')).get_json()
+    assert admin == {
+        'lot_names': ['Lot A'],
+        'lot_counts': [3],
+        'lot_revenues': [120.0],
+        'total_revenue': 120.0,
+        'total_reservations': 3
+    }
+
+
+def test_lot_stats_follow_bookings_and_rebuild(client):
+    headers = auth(2, 'user')
+    for vehicle in ('TN01A', 'TN01B'):
+        assert book(client, headers, vehicle).status_code == 200
+    assert client.put('/api/user_reservations/1/release', headers=headers).status_code == 200
+
+    incremental = client.get('/api/user/summary', headers=headers).get_json()
+    assert incremental['lot_counts'] == [2]
+    assert incremental['total_spent'] == 120.0
+    assert incremental['active_reservations'] == 1
+    assert incremental['completed_reservations'] == 1
+
+    rebuild_lot_stats()
+    cache.clear()
+    assert client.get('/api/user/summary', headers=headers).get_json() == incremental
+
+
+def test_per_user_cache_is_keyed_on_identity(client):
+    alice, admin_as_user = auth(2, 'user'), auth(1, 'user')
+    assert book(client, alice, 'TN01A').status_code == 200
+
+    for url in ('/api/user/my_reservations', '/api/user/summary'):
+        first = client.get(url, headers=alice).get_json()
+        with count_queries() as statements:
+            assert client.get(url, headers=alice).get_json() == first
+        assert statements == []
+        assert client.get(url, headers=admin_as_user).get_json() != first
+
+    assert client.put('/api/user_reservations/1/release', headers=alice).status_code == 200
+    assert client.get('/api/user/my_reservations', headers=alice).get_json()[0]['status'] == 'completed'
+    assert client.get('/api/user/summary', headers=alice).get_json()['completed_reservations'] == 1
+
+    client.put('/api/update/parkinglot/1', headers=auth(1, 'admin'), json={'price': 25.0})
+    assert client.get('/api/user/my_reservations', headers=alice).get_json()[0]['parking_lot']['price'] == 25.0
+
+
+def test_spot_calendar_matches_database(client):
+    headers = auth(2, 'user')
+    for i in range(3):
+        assert book(client, headers, f'TN01{i}').status_code == 200
+    assert client.put('/api/user_reservations/2/release', headers=headers).status_code == 200
+
+    assert spot_calendar.check() == {}
+    assert len(spot_calendar.free_spots(1, datetime(2026, 1, 1, 11), datetime(2026, 1, 1, 12))) == 98
+    assert db.session.get(ParkingSpot, 2).status == 'available'
+
+    add_reservations(1)  # written behind the calendar's back
+    assert spot_calendar.check() == {1: {1}}
+    assert spot_calendar.verify() == {1: {1}}
+    assert spot_calendar.check() == {}
+
+
+def test_full_lot_is_rejected(client):
+    add_reservations(100)
+    spot_calendar.load()
+    assert book(client, auth(2, 'user'), 'TN01X').status_code == 400
+
+
+def test_bookings_only_block_their_own_window(client):
+    headers = auth(2, 'user')
+    add_reservations(100)  # every spot is taken 10:00-12:00
+    spot_calendar.load()
+
+    def book_window(start, end):
+        return client.post('/api/user_reservation', headers=headers, json={
+            'selected_lot': 1, 'vehicle_number': 'TN01W', 'start_time': start, 'end_time': end})
+
+    def free(start, end):
+        return client.get(f'/api/parkinglots/1/availability?start={start}&end={end}', headers=headers).get_json()['free_spots']
+
+    assert free('2026-01-01T11:00', '2026-01-01T13:00') == 0
+    assert book_window('2026-01-01T11:00', '2026-01-01T13:00').status_code == 400
+    assert free('2026-01-01T12:00', '2026-01-01T13:00') == 100
+    assert book_window('2026-01-01T12:00', '2026-01-01T13:00').status_code == 200
+    assert book_window('2026-01-02T08:00', '2026-01-02T18:00').status_code == 200  # advance booking
+    assert free('2026-01-01T12:30', '2026-01-01T12:45') == 99
+    assert free('2026-01-02T17:00', '2026-01-02T19:00') == 99
+    assert free('2026-01-01T08:00', '2026-01-01T10:00') == 100
+
+    assert book_window('2026-01-03T10:00', '2026-01-03T09:00').status_code == 400
+    assert client.get('/api/parkinglots/1/availability?start=tomorrow', headers=headers).status_code == 400
+    assert spot_calendar.check() == {}
+
+
+def test_concurrent_bookings_never_share_a_spot(client):
+    # a quick check of the locking at test-suite size (160 bookings). The stress check is
+    # python benchmark.py bookings [bookings threads spots], 3000 bookings from 32 threads by default
+    headers = auth(2, 'user')
+    statuses = []
+
+    def worker(number):
+        with app.test_client() as thread_client:
+            for i in range(10):
+                statuses.append(book(thread_client, headers, f'TN{number:02d}{i:02d}').status_code)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses.count(200) == 100
+    assert statuses.count(400) == 60
+    spot_ids = [reservation.parking_spot_id for reservation in Reservation.query.all()]
+    assert len(spot_ids) == len(set(spot_ids)) == 100
+    assert ParkingSpot.query.filter_by(status='available').count() == 0
+    assert spot_calendar.check() == {}
+
+
+def test_hot_queries_use_indexes(client):
+    add_reservations(20)
+    assert find_full_scans(client, user_id=2, admin_id=1) == []
+
+
+@pytest.mark.parametrize('url,role', [
+    ('/api/admin/reservations', 'admin'),
+    ('/api/get/parkinglots', 'admin'),
+    ('/api/get/user/parkinglots', 'user'),
+    ('/api/get-data', 'admin'),
+])
+def test_keyset_pages_match_the_full_list(client, url, role):
+    add_reservations(25)
+    for i in range(2, 8):
+        create_lot_with_spots({'name': f'Lot {i}', 'city': 'Chennai', 'location': 'IITM', 'price': 10.0, 'total_spots': 1})
+        db.session.add(User(username=f'user{i}', email=f'user{i}@gmail.com', password='x'))
+    db.session.commit()
+    headers = auth(1, role)
+
+    full = client.get(url, headers=headers).get_json()
+    assert isinstance(full, list)
+
+    paged, cursor = [], 0
+    while cursor is not None:
+        page = client.get(f'{url}?limit=3&after={cursor}', headers=headers).get_json()
+        assert len(page['data']) <= 3
+        paged += page['data']
+        cursor = page['next_cursor']
+    assert paged == full
+
+
+def test_lot_catalog_is_cached_until_a_write(client):
+    admin, user = auth(1, 'admin'), auth(2, 'user')
+    first = client.get('/api/get/user/parkinglots', headers=user).get_json()
+
+    with count_queries() as statements:
+        assert client.get('/api/get/user/parkinglots', headers=user).get_json() == first
+        assert client.get('/api/get/parkinglots', headers=admin).get_json() == first
+    assert statements == []
+
+    client.post('/api/create/parkinglot', headers=admin, json={'name': 'Lot B', 'city': 'Chennai', 'location': 'Guindy', 'price': 15.0, 'total_spots': 5})
+    assert [lot['name'] for lot in client.get('/api/get/user/parkinglots', headers=user).get_json()] == ['Lot A', 'Lot B']
+
+    client.put('/api/update/parkinglot/1', headers=admin, json={'price': 25.0})
+    assert client.get('/api/get/parkinglots', headers=admin).get_json()[0]['price'] == 25.0
+
+    client.post('/api/import/parkinglots', headers=admin, json={'parkinglots': [{'name': 'Lot C', 'city': 'Chennai', 'location': 'Adyar', 'price': 10.0, 'total_spots': 5}]})
+    assert len(client.get('/api/get/parkinglots?limit=10', headers=admin).get_json()['data']) == 3
+
+    # a bad lot anywhere in an import is reported by index before anything is written
+    good = {'name': 'Lot D', 'city': 'Chennai', 'location': 'Adyar', 'price': 10.0, 'total_spots': 5}
+    for body, index in (({'parkinglots': [good, {'name': 'X'}]}, 1), ({'parkinglots': [{**good, 'total_spots': '5'}]}, 0),
+                        ({'parkinglots': [{**good, 'price': True}]}, 0), ({'parkinglots': [good, good, 'Lot E']}, 2),
+                        ({'parkinglots': {'name': 'X'}}, None), ([good], None)):
+        response = client.post('/api/import/parkinglots', headers=admin, json=body)
+        assert response.status_code == 400 and response.get_json().get('index') == index
+    from models import ParkingLot
+    assert ParkingLot.query.count() == 3 and ParkingSpot.query.count() == 110
+
+
+@pytest.mark.parametrize('url,role', [
+    ('/api/get/user/parkinglots', 'user'),
+    ('/api/admin/reservations', 'admin'),
+    ('/api/admin/summary', 'admin'),
+])
+def test_unchanged_reads_return_not_modified(client, url, role):
+    headers = auth(1 if role == 'admin' else 2, role)
+    first = client.get(url, headers=headers)
+    assert first.status_code == 200 and first.headers['ETag']
+
+    with count_queries() as statements:
+        again = client.get(url, headers={**headers, 'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+    assert statements == []
+
+    assert book(client, auth(2, 'user'), 'TN01A').status_code == 200
+    client.put('/api/update/parkinglot/1', headers=auth(1, 'admin'), json={'price': 25.0})
+    changed = client.get(url, headers={**headers, 'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200 and changed.headers['ETag'] != first.headers['ETag']
+
+
+def test_etag_is_not_shared_with_other_roles(client):
+    admin = client.get('/api/admin/summary', headers=auth(1, 'admin'))
+    response = client.get('/api/admin/summary', headers={**auth(2, 'user'), 'If-None-Match': admin.headers['ETag']})
+    assert response.status_code == 403
+
+
+def test_streamed_export_is_scoped_to_the_caller(client):
+    add_reservations(3)
+    add_reservations(2, user_id=1)
+
+    response = client.get('/api/export/reservations.csv', headers=auth(2, 'user'))
+    assert response.status_code == 200 and response.mimetype == 'text/csv'
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0].startswith('id,user_name,vehicle_number')
+    assert len(lines) == 4 and all(',alice,' in line for line in lines[1:])
+
+    response = client.get('/api/export/reservations.ndjson', headers=auth(1, 'admin'))
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [record['user_name'] for record in records] == ['alice'] * 3 + ['admin'] * 2
+    assert records[0]['start_time'] == '2026-01-01T10:00:00'
+
+    only_alice = client.get('/api/export/reservations.ndjson?user_id=2', headers=auth(1, 'admin'))
+    assert len(only_alice.get_data(as_text=True).splitlines()) == 3
+    assert client.get('/api/export/reservations.ndjson?user_id=abc', headers=auth(1, 'admin')).status_code == 400
+    assert client.get('/api/export/reservations.xml', headers=auth(1, 'admin')).status_code == 404
+
+
+def test_report_tasks_attach_spooled_files(client, monkeypatch):
+    import tasks
+    sent = []
+    monkeypatch.setattr(tasks, 'send_email', lambda to_address, subject, message, content='text', attachments=():
+                        sent.append((to_address, {name: file.read().decode() for name, file in attachments})))
+    monkeypatch.setattr(tasks, 'REPORT_CHUNK_ROWS', 7)
+    add_reservations(20)
+    add_reservations(5, user_id=1)
+
+    tasks.export_reservations_report(2)
+    to_address, files = sent.pop()
+    assert to_address == 'alice@gmail.com'
+    assert len(files['reservations.csv'].splitlines()) == 21
+    assert files['reservations.html'].count('Vehicle Number') == 20
+    assert '20 reservations in total' in files['reservations.html'] and 'Total cost: 800.0' in files['reservations.html']
+
+    tasks.send_monthly_report('2026-01')
+    to_address, files = sent.pop()
+    assert to_address == 'admin@gmail.com'
+    assert files['monthly_report_2026-01.html'].count('<p>User: alice</p>') == 20
+    assert files['monthly_report_2026-01.html'].count('<p>User: admin</p>') == 5
+    assert '<tr><td>Lot A</td><td>25</td><td>1000.0</td></tr>' in files['monthly_report_2026-01.html']
+    assert '<td>2026-01</td>' not in files['monthly_report_2026-01.html']  # previous months only
+
+
+def test_smtp_pool_reuses_and_replaces_connections():
+    pytest.importorskip('aiosmtpd')
+    from benchmark import smtp_sink
+    from mailer import SMTPPool
+    from tasks import build_email
+    controller, sink = smtp_sink()
+    pool = SMTPPool(controller.hostname, controller.port, 'admin@gmail.com', '')
+    try:
+        emails = [build_email(f'user{i}@gmail.com', 'Daily Reminder', 'hello') for i in range(5)]
+        assert pool.send_many(emails) == 5
+        connection = pool.idle[0][0]
+        assert pool.send(emails[0]) and pool.idle[0][0] is connection
+
+        connection.sock.shutdown(socket.SHUT_RDWR)  # the connection drops while idle
+        assert pool.send_many(emails) == 5
+        assert pool.idle[0][0] is not connection
+
+        pool.check_after = 0
+        pool.idle[0][0].sock.shutdown(socket.SHUT_RDWR)
+        assert pool.send(emails[0])  # NOOP health check fails, a new connection is opened
+        assert sink.received == 12
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+def test_daily_reminders_fan_out_in_id_ranges(client, monkeypatch):
+    import tasks
+    sent = []
+    monkeypatch.setattr(tasks, 'send_emails', lambda emails: sent.append(list(emails)) or len(sent[-1]))
+    monkeypatch.setattr(tasks, 'REMINDER_CHUNK_SIZE', 7)
+    monkeypatch.setitem(tasks.celery_app.conf, 'task_always_eager', True)
+    add_reservations(20)
+    db.session.get(Reservation, 5).status = 'completed'
+    db.session.commit()
+
+    ranges = tasks.active_id_ranges(7)
+    assert ranges == [(0, 8), (8, 15), (15, 20)]
+
+    tasks.send_daily_reminder(digest=False)
+    assert [len(chunk) for chunk in sent] == [7, 7, 5]
+    assert tasks.summarize_reminders([{'reservations': 7, 'sent': 7, 'failed': 0}, {'reservations': 5, 'sent': 4, 'failed': 1}]) == \
+        {'reservations': 12, 'sent': 11, 'failed': 1, 'chunks': 2}
+
+
+def test_digest_reminders_send_one_mail_per_user(client, monkeypatch):
+    import tasks
+    sent = []
+
+    def send_emails(emails):
+        emails = list(emails)
+        sent.extend(emails)
+        return len(emails)
+
+    monkeypatch.setattr(tasks, 'send_emails', send_emails)
+    monkeypatch.setattr(tasks, 'REMINDER_CHUNK_SIZE', 1)
+    monkeypatch.setitem(tasks.celery_app.conf, 'task_always_eager', True)
+    add_reservations(30)
+    add_reservations(2, user_id=1)
+
+    tasks.send_daily_reminder()
+    assert [email[0] for email in sent] == ['admin@gmail.com', 'alice@gmail.com']
+    assert sent[1][2].count('- TN01') == 30 and 'at Lot A' in sent[1][2]
+    assert tasks.send_digest_chunk(1, 2) == {'reservations': 30, 'sent': 1, 'failed': 0}
+
+
+def test_monthly_rollups_only_take_in_new_reservations(client):
+    from summary import roll_up_months, month_rollups, period_totals
+    add_reservations(10)
+    assert roll_up_months() == 10
+    assert roll_up_months() == 0
+    assert month_rollups('2026-01') == [('Lot A', 10, 400.0)]
+
+    db.session.add(Reservation(user_id=2, parking_spot_id=50, vehicle_number='TN01FEB', start_time=datetime(2026, 2, 3, 9, 0),
+                               end_time=datetime(2026, 2, 3, 10, 0), status='active', cost=20.0))
+    db.session.commit()
+    with count_queries() as statements:
+        assert roll_up_months() == 1
+    grouped = [statement for statement in statements if 'GROUP BY' in statement]
+    assert grouped and all('reservation.id > ?' in statement for statement in grouped)
+    assert month_rollups('2026-01') == [('Lot A', 10, 400.0)]
+    assert period_totals() == [('2026-02', 1, 20.0), ('2026-01', 10, 400.0)]
+    assert period_totals('2026-02') == [('2026-01', 10, 400.0)]
+
+
+def test_occupancy_rollups_follow_completed_reservations(client):
+    from summary import rebuild_occupancy
+    from models import LotOccupancy
+    headers, admin = auth(2, 'user'), auth(1, 'admin')
+    client.post('/api/user_reservation', headers=headers, json={
+        'selected_lot': 1, 'vehicle_number': 'TN01A', 'start_time': '2026-01-01T10:30', 'end_time': '2026-01-01T12:00'})
+    book(client, headers, 'TN01B')  # 10:00-13:00, still active
+    assert LotOccupancy.query.count() == 0
+    assert client.put('/api/user_reservations/1/release', headers=headers).status_code == 200
+
+    url = '/api/admin/occupancy?lot_id=1&from=2026-01-01T00:00&to=2026-01-02T00:00'
+    points = client.get(url, headers=admin).get_json()['points']
+    assert [(point['time'], point['spot_hours'], point['revenue']) for point in points] == [
+        ('2026-01-01T10:00:00', 0.5, 10.0), ('2026-01-01T11:00:00', 1.0, 20.0)]
+    assert points[1]['occupancy'] == 0.01
+
+    assert client.put('/api/user_reservations/2/release', headers=headers).status_code == 200
+    day = client.get(url + '&bucket=day', headers=admin).get_json()['points']
+    assert day == [{'time': '2026-01-01T00:00:00', 'spot_hours': 4.5, 'revenue': 90.0, 'occupancy': 4.5 / 2400}]
+    # from falls inside a bucket: the whole bucket is reported
+    assert client.get(url.replace('T00:00&', 'T10:30&') + '&bucket=hour', headers=admin).get_json()['points'][0] == \
+        {'time': '2026-01-01T10:00:00', 'spot_hours': 1.5, 'revenue': 30.0, 'occupancy': 0.015}
+    assert client.get(url.replace('T00:00&', 'T12:00&') + '&bucket=day', headers=admin).get_json()['points'] == day
+
+    incremental = [(row.hour, row.spot_hours, row.revenue) for row in LotOccupancy.query.order_by(LotOccupancy.hour)]
+    rebuild_occupancy()
+    assert [(row.hour, row.spot_hours, row.revenue) for row in LotOccupancy.query.order_by(LotOccupancy.hour)] == incremental
+    assert client.get(url + '&bucket=week', headers=admin).status_code == 400
+    assert client.get(url.replace('lot_id=1', 'lot_id=abc'), headers=admin).status_code == 400
+    assert client.get(url, headers=headers).status_code == 403
+
+    # all lots: a deleted lot drops out of both the spot-hours and the capacity
+    from models import ParkingLot
+    create_lot_with_spots({'name': 'Lot B', 'city': 'Chennai', 'location': 'IITM', 'price': 20.0, 'total_spots': 100})
+    db.session.add(LotOccupancy(parking_lot_id=2, hour=datetime(2026, 1, 1, 10), spot_hours=100.0, revenue=0.0))
+    db.session.commit()
+    all_lots = url.replace('lot_id=1&', '') + '&bucket=day'
+    assert client.get(all_lots, headers=admin).get_json()['points'][0]['occupancy'] == 104.5 / 4800
+    db.session.get(ParkingLot, 2).is_deleted = True
+    db.session.commit()
+    assert client.get(all_lots, headers=admin).get_json()['points'] == day
+
+
+def test_quotes_follow_hourly_rates_and_match_bookings(client):
+    headers, admin = auth(2, 'user'), auth(1, 'admin')
+
+    def quotes(*windows):
+        items = [{'lot_id': lot_id, 'start_time': start, 'end_time': end} for lot_id, start, end in windows]
+        return client.post('/api/quotes', headers=headers, json={'quotes': items}).get_json()['costs']
+
+    assert quotes((1, '2026-01-01T10:30', '2026-01-01T12:00'), (1, '2026-01-01T22:00', '2026-01-03T02:00'),
+                  (9, '2026-01-01T10:00', '2026-01-01T11:00'), (1, '2026-01-01T11:00', '2026-01-01T10:00')) == [
+        30.0, 560.0, None, None]
+
+    multipliers = [1.0] * 24
+    multipliers[11] = 2.0  # peak hour 11:00-12:00
+    multipliers[23] = 0.0  # free 23:00-24:00
+    assert client.put('/api/update/parkinglot/1/rates', headers=headers, json={'multipliers': multipliers}).status_code == 403
+    assert client.put('/api/update/parkinglot/1/rates', headers=admin, json={'multipliers': [1.0] * 23}).status_code == 400
+    assert client.put('/api/update/parkinglot/1/rates', headers=admin, json={'multipliers': multipliers}).status_code == 200
+
+    # 10:30-11:00 at 1x + 11:00-12:00 at 2x; 22:00-23:00 + a 24 rated hour day + 00:00-02:00
+    assert quotes((1, '2026-01-01T10:30', '2026-01-01T12:00'), (1, '2026-01-01T22:00', '2026-01-03T02:00')) == [50.0, 540.0]
+    client.post('/api/user_reservation', headers=headers, json={
+        'selected_lot': 1, 'vehicle_number': 'TN01A', 'start_time': '2026-01-01T10:30', 'end_time': '2026-01-01T12:00'})
+    assert db.session.get(Reservation, 1).cost == 50.0
+
+    assert client.put('/api/update/parkinglot/1/rates', headers=admin, json={'multipliers': []}).status_code == 200
+    assert quotes((1, '2026-01-01T10:30', '2026-01-01T12:00')) == [30.0]
+    assert quotes(*[(1, '2026-01-01T10:00', '2026-01-01T12:00')] * 10000) == [40.0] * 10000
+    assert client.post('/api/quotes', headers=headers, json={'quotes': [{'lot_id': 1}]}).status_code == 400
+    assert client.post('/api/quotes', headers=headers, json={'quotes': [{}] * 10001}).status_code == 400
+    window = {'start_time': '2026-01-01T10:00', 'end_time': '2026-01-01T12:00'}
+    for bad in ({**window, 'lot_id': True}, {**window, 'lot_id': 1.5}, {**window, 'lot_id': 2 ** 64},
+                {**window, 'lot_id': 1, 'start_time': '2026-01-01'}, {**window, 'lot_id': 1, 'end_time': '2026-01-01T12:00:30'},
+                {**window, 'lot_id': 1, 'end_time': '2026-13-01T12:00'}, {**window, 'lot_id': 1, 'end_time': 1767261600}):
+        assert client.post('/api/quotes', headers=headers, json={'quotes': [bad]}).status_code == 400, bad
+    for bad in ([True] * 24, [1.0] * 23 + [None], [1.0] * 23 + [-1]):
+        assert client.put('/api/update/parkinglot/1/rates', headers=admin, json={'multipliers': bad}).status_code == 400
+
+
+def test_batch_bookings_report_each_item(client):
+    headers = auth(2, 'user')
+    add_reservations(98)  # spots 1-98 taken 10:00-12:00
+    spot_calendar.load()
+
+    def batch(items, **options):
+        return client.post('/api/user_reservations/batch', headers=headers, json={'selected_lot': 1, 'reservations': items, **options})
+
+    fleet = [{'vehicle_number': f'TN02{i:02d}', 'start_time': '2026-01-01T11:00', 'end_time': '2026-01-01T12:00'} for i in range(3)]
+    fleet.append({'vehicle_number': 'TN02LATE', 'start_time': '2026-01-01T12:00', 'end_time': '2026-01-01T14:00'})
+    fleet.append({'vehicle_number': 'TN02BAD', 'start_time': '2026-01-01T14:00', 'end_time': '2026-01-01T13:00'})
+    fleet.append({'vehicle_number': None, 'start_time': '2026-01-01T14:00', 'end_time': '2026-01-01T15:00'})
+
+    response = batch(fleet, all_or_nothing=True).get_json()
+    assert response['booked'] == 0
+    assert [result['status'] for result in response['results']] == ['skipped', 'skipped', 'skipped', 'skipped', 'invalid', 'invalid']
+    assert Reservation.query.count() == 98 and spot_calendar.check() == {}
+
+    response = batch(fleet).get_json()
+    assert [result['status'] for result in response['results']] == ['booked', 'booked', 'full', 'booked', 'invalid', 'invalid']
+    assert [result['spot_id'] for result in response['results'] if result['status'] == 'booked'] == [99, 100, 1]
+    assert response['results'][3]['cost'] == 40.0
+    assert Reservation.query.count() == 101 and spot_calendar.check() == {}
+    assert db.session.get(ParkingSpot, 99).status == 'reserved'
+
+    summary = client.get('/api/user/summary', headers=headers).get_json()
+    assert summary['total_spent'] == 20.0 + 20.0 + 40.0  # add_reservations wrote around the stats
+    assert batch([]).status_code == 400
+
+
+def test_logins_rehash_when_the_policy_changes(client, monkeypatch):
+    import threading
+    from passwords import hasher
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    assert client.post('/api/register', json={'username': 'bob', 'email': 'bob@gmail.com', 'password': 'pw'}).status_code == 200
+    bob = User.query.filter_by(username='bob').one()
+    assert bob.password.startswith('pbkdf2:sha256:1000$')
+
+    def login(password, url='/api/login'):
+        return client.post(url, json={'username': 'bob', 'password': password})
+
+    assert login('wrong').status_code == 401
+    assert login('pw').status_code == 200
+    assert login('pw', '/api/admin/login').status_code == 401
+    first_hash = bob.password
+
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:2000')
+    assert login('wrong').status_code == 401
+    db.session.refresh(bob)
+    assert bob.password == first_hash  # a failed login changes nothing
+    assert login('pw').status_code == 200
+    db.session.refresh(bob)
+    assert bob.password.startswith('pbkdf2:sha256:2000$')
+    second_hash = bob.password
+    assert login('pw').status_code == 200
+    db.session.refresh(bob)
+    assert bob.password == second_hash
+
+    hasher.pool()
+    monkeypatch.setattr(hasher, 'slots', threading.BoundedSemaphore(1))
+    hasher.slots.acquire()  # the queue is full
+    response = login('pw')
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+
+
+def test_refresh_tokens_skip_the_password_hash(client, monkeypatch):
+    from passwords import hasher
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    client.post('/api/register', json={'username': 'bob', 'email': 'bob@gmail.com', 'password': 'pw'})
+    data = client.post('/api/login', json={'username': 'bob', 'password': 'pw'}).get_json()['data']
+
+    def no_hashing(*args):
+        raise AssertionError('refresh must not hash')
+    monkeypatch.setattr(hasher, 'run', no_hashing)
+    refresh = {'Authorization': f'Bearer {data["refresh_token"]}'}
+    with count_queries() as statements:
+        response = client.post('/api/token/refresh', headers=refresh)
+    assert response.status_code == 200 and len(statements) == 1
+
+    access = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+    assert client.get('/api/user/my_reservations', headers=access).status_code == 200
+    assert client.post('/api/token/refresh', headers=access).status_code == 422  # an access token cannot refresh
+    assert client.get('/api/user/my_reservations', headers=refresh).status_code == 422
+
+    User.query.filter_by(username='bob').delete()
+    db.session.commit()
+    assert client.post('/api/token/refresh', headers=refresh).status_code == 401
+
+
+def test_logout_revokes_tokens_through_the_bloom_filter(client, monkeypatch):
+    from models import RevokedToken
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    for username in ('bob', 'carol'):
+        client.post('/api/register', json={'username': username, 'email': f'{username}@gmail.com', 'password': 'pw'})
+
+    def login(username='bob'):
+        data = client.post('/api/login', json={'username': username, 'password': 'pw'}).get_json()['data']
+        return {'Authorization': f'Bearer {data["access_token"]}'}, data['refresh_token']
+
+    (access, refresh), (other_access, _) = login(), login()
+    response = client.post('/api/logout', headers=access, json={'refresh_token': login('carol')[1]})
+    assert response.status_code == 400  # not bob's refresh token
+    assert client.post('/api/logout', headers=access, json={'refresh_token': refresh}).status_code == 200
+    assert client.get('/api/user/my_reservations', headers=access).status_code == 401
+    assert client.post('/api/token/refresh', headers={'Authorization': f'Bearer {refresh}'}).status_code == 401
+    assert client.get('/api/user/my_reservations', headers=other_access).status_code == 200
+    assert RevokedToken.query.count() == 2
+    assert revocations.filter.count == 2 and revocations.last_id == 2  # each jti added once
+
+    with count_queries() as statements:
+        assert not revocations.is_revoked('never-revoked')
+    assert statements == []
+    revocations.filter.add('false-positive')
+    assert not revocations.is_revoked('false-positive')  # a filter hit is settled by the table
+
+    # a revocation written by another process is seen on the next refresh
+    monkeypatch.setattr(revocations, 'refresh_every', 0)
+    db.session.add(RevokedToken(jti='from-another-worker', expires=2 ** 31))
+    db.session.commit()
+    assert revocations.is_revoked('from-another-worker')
+
+
+def test_failed_bookings_hand_their_calendar_windows_back(client):
+    from sqlalchemy.exc import IntegrityError
+    from models import ParkingLot
+    from booking import book_spot
+    headers = auth(2, 'user')
+    body = {'selected_lot': 1, 'vehicle_number': 'TN01A', 'start_time': '2026-01-01T10:00', 'end_time': '2026-01-01T12:00'}
+    assert client.post('/api/user_reservation', headers=headers, json=dict(body, vehicle_number=None)).status_code == 400
+    assert client.post('/api/user_reservation', headers=headers, json=dict(body, vehicle_number='X' * 21)).status_code == 400
+    assert client.post('/api/user_reservation', headers=headers, json=dict(body, start_time='tomorrow')).status_code == 400
+    del body['vehicle_number']
+    assert client.post('/api/user_reservation', headers=headers, json=body).status_code == 400
+
+    with pytest.raises(IntegrityError):
+        book_spot(db.session.get(ParkingLot, 1), 2, None, datetime(2026, 1, 1, 10), datetime(2026, 1, 1, 12), 40.0)
+    assert spot_calendar.check() == {}
+    assert len(spot_calendar.free_spots(1, datetime(2026, 1, 1, 10), datetime(2026, 1, 1, 12))) == 100
+
+
+def test_reloads_keep_uncommitted_windows_and_run_one_at_a_time(client, monkeypatch):
+    start, end = datetime(2026, 1, 1, 10), datetime(2026, 1, 1, 12)
+    lot = spot_calendar.lot(1)
+    held = spot_calendar.take(1, start, end)  # booked in the calendar, its reservation not committed yet
+    during = []
+    scan = spot_calendar.scan
+
+    def booking_during_scan(parking_lot_id=None):
+        spots = scan(parking_lot_id)
+        during.append(spot_calendar.take(1, start, end))
+        return spots
+
+    monkeypatch.setattr(spot_calendar, 'scan', booking_during_scan)
+    spot_calendar.load()
+    free = spot_calendar.free_spots(1, start, end)
+    assert spot_calendar.lot(1) is lot
+    assert held not in free and during[0] not in free and len(free) == 98
+    spot_calendar.settle(1, [(held, start, end)])
+    monkeypatch.setattr(spot_calendar, 'scan', scan)
+    spot_calendar.load()
+    assert held in spot_calendar.free_spots(1, start, end)  # settled but never committed: the database wins
+
+    verified = []
+    monkeypatch.setattr(spot_calendar, 'verify', lambda: verified.append(1))
+    monkeypatch.setattr(spot_calendar, 'loaded_at', time.monotonic() - spot_calendar.verify_every)
+    reloading, finish = threading.Event(), threading.Event()
+
+    def reload_elsewhere():
+        with spot_calendar.refreshing:
+            reloading.set()
+            finish.wait()
+
+    other = threading.Thread(target=reload_elsewhere)
+    other.start()
+    reloading.wait()
+    assert len(spot_calendar.free_spots(1, start, end)) == 99  # no waiting for the other reload, no second one
+    assert verified == []
+    finish.set()
+    other.join()
+
+
+def test_calendar_slot_masks_agree_with_the_windows():
+    from allocator import LotCalendar
+    lot = LotCalendar({spot_id: ([], []) for spot_id in (1, 2, 3)})
+    day = datetime(2026, 1, 1)
+
+    def at(hour, minute=0, days=0):
+        return datetime(2026, 1, 1 + days, hour, minute)
+
+    lot.insert(1, at(10), at(12))
+    lot.insert(2, at(10), at(10, 20))  # shares the 10:15 slot with a 10:20 start
+    lot.insert(3, at(22), at(2, days=1))  # overnight
+    assert lot.free_spots(at(10, 20), at(12)) == [2, 3]
+    assert lot.free_spots(at(10, 10), at(11)) == [3]
+    assert lot.free_spots(at(23), at(1, days=1)) == [1, 2]
+    assert lot.free_spots(at(1, days=1), at(3, days=1)) == [1, 2]
+    assert [spot_id for spot_id, window in zip(lot.candidates(at(12), at(13)), range(3))] == [1, 2, 3]
+
+    lot.insert(4, at(11), at(12))  # a spot the calendar was not loaded with
+    assert lot.free_spots(at(11), at(12)) == [2, 3]
+    lot.delete(1, at(10), at(12))
+    lot.delete(3, at(22), at(2, days=1))
+    assert lot.free_spots(day, at(0, days=3)) == [1, 3]
+    assert lot.free_spots(at(10, 30), at(11)) == [1, 2, 3, 4]
+
+
+def test_new_stats_tables_are_filled_from_existing_reservations(client):
+    add_reservations(3)
+    from models import LotStats, UserLotStats
+    for model in (UserLotStats, LotStats):
+        model.__table__.drop(db.engine)
+
+    result = app.test_cli_runner().invoke(args=['create-indexes'])
+    assert 'lot_stats built from reservations' in result.output
+    assert client.get('/api/admin/summary', headers=auth(1, 'admin')).get_json()['total_reservations'] == 3
+    assert client.get('/api/user/summary', headers=auth(2, 'user')).get_json()['lot_counts'] == [3]
+
+    again = app.test_cli_runner().invoke(args=['create-indexes'])
+    assert 'lot_stats built' not in again.output
+
+
+def test_refused_and_undeliverable_reminders_are_counted_as_failed(client, monkeypatch):
+    pytest.importorskip('aiosmtpd')
+    import tasks
+    from benchmark import smtp_sink
+    from mailer import SMTPPool
+    controller, sink = smtp_sink(refuse={'TN010002'})
+    monkeypatch.setattr(tasks, 'mailer', SMTPPool(controller.hostname, controller.port, 'admin@gmail.com', ''))
+    add_reservations(4)
+    try:
+        assert tasks.send_reminder_chunk(0, 4) == {'reservations': 4, 'sent': 3, 'failed': 1}
+    finally:
+        tasks.mailer.close_all()
+        controller.stop()
+    # nothing listens on the port any more
+    assert tasks.send_reminder_chunk(0, 4) == {'reservations': 4, 'sent': 0, 'failed': 4}
+
+
+def test_a_lost_version_key_never_brings_back_an_old_body(client):
+    admin = auth(1, 'admin')
+    client.put('/api/update/parkinglot/1', headers=admin, json={'price': 21.0})
+    assert client.get('/api/get/parkinglots', headers=admin).get_json()[0]['price'] == 21.0
+
+    cache.delete('parkinglots:version')  # evicted, or expired on a backend that expires it
+    client.put('/api/update/parkinglot/1', headers=admin, json={'price': 99.0})
+    assert client.get('/api/get/parkinglots', headers=admin).get_json()[0]['price'] == 99.0
@@ -1,9 +1,31 @@
 import './assets/main.css'
 
 import { createApp } from 'vue'
+import axios from 'axios'
 import App from './App.vue'
 import router from './router'
 
+// access tokens last 15 minutes: when one has expired, get a new one with the refresh token
+// saved at login and retry the request once, instead of sending the user back to the login page
+const refreshTokenKeys = { token: 'refresh_token', admin_token: 'admin_refresh_token' }
+
+axios.interceptors.response.use(null, async (error) => {
+  const request = error.config
+  const sent = request?.headers?.Authorization
+  const tokenKey = Object.keys(refreshTokenKeys).find((key) => sent === `Bearer ${localStorage.getItem(key)}`)
+  const refreshToken = tokenKey && localStorage.getItem(refreshTokenKeys[tokenKey])
+  if (error.response?.status !== 401 || !refreshToken || request._retried) {
+    throw error
+  }
+  const response = await axios.post('http://localhost:5000/api/token/refresh', null, {
+    headers: { Authorization: `Bearer ${refreshToken}` },
+  })
+  localStorage.setItem(tokenKey, response.data.access_token)
+  request._retried = true
+  request.headers.Authorization = `Bearer ${response.data.access_token}`
+  return axios(request)
+})
+
 const app = createApp(App)
 
 app.use(router)
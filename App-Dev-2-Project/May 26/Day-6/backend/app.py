@@ -1,9 +1,16 @@
 from flask import Flask , jsonify, request
 from flask_cors import CORS
-from model import db , User, ParkingLot, ParkingSpot, Reservation
+from model import db , User, ParkingLot, ParkingSpot, Reservation, RevokedToken, create_indexes
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
 from flask_caching import Cache
+from sqlalchemy import insert, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from summary import lot_totals, status_counts, reservation_booked, reservation_released, rebuild_lot_stats
+from datetime import timedelta
+import time
 
 app = Flask(__name__)
 
@@ -13,12 +20,14 @@ app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///app.db"
 app.config["SECRET_KEY"] = "your-secret-key"
 
 app.config["JWT_SECRET_KEY"] = "your-key"
+app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(minutes=15)
+app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=30)  # how long a login lasts without the password
 app.config["CACHE_TYPE"] = "RedisCache"
 app.config["CACHE_REDIS_URL"] = "redis://localhost:6379/0"
 
 CORS(app)
 
-JWTManager(app)
+jwt = JWTManager(app)
 
 cache = Cache(app)
 
@@ -26,6 +35,12 @@ cache = Cache(app)
 db.init_app(app)
 
 
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    # one lookup on the unique jti index per protected request
+    return db.session.query(RevokedToken.id).filter_by(jti=jwt_payload["jti"]).first() is not None
+
+
 @app.route("/register" , methods=["GET" , "POST"])
 def register():
     data = request.get_json()
@@ -62,12 +77,47 @@ def login():
             if not user or not check_password_hash(user.password, password):
                 return jsonify({"error": "Invalid username or password"}), 401
             access_token = create_access_token(identity=user.id, additional_claims={"role": "admin"})
-            return jsonify({"message": "Admin login successful", "role": "admin", "access_token": access_token}), 200
+            refresh_token = create_refresh_token(identity=user.id)
+            return jsonify({"message": "Admin login successful", "role": "admin", "access_token": access_token, "refresh_token": refresh_token}), 200
         if user:
             if not user or not check_password_hash(user.password, password):
                 return jsonify({"error": "Invalid username or password"}), 401
             access_token = create_access_token(identity=user.id, additional_claims={"role": "user"})
-            return jsonify({"message": "Login successful", "role": "user", "access_token": access_token}), 200
+            refresh_token = create_refresh_token(identity=user.id)
+            return jsonify({"message": "Login successful", "role": "user", "access_token": access_token, "refresh_token": refresh_token}), 200
+
+@app.route("/api/token/refresh", methods=["POST"])
+@jwt_required(refresh=True)
+def refresh_token():
+    # a new access token for the refresh token's user, with no password check; the role is read again
+    # with one primary key lookup so a changed role or a deleted user takes effect on the next refresh
+    user_id = get_jwt_identity()
+    role = db.session.query(User.role).filter(User.id == user_id).scalar()
+    if role is None:
+        return jsonify({"error": "User not found"}), 401
+    access_token = create_access_token(identity=user_id, additional_claims={"role": role})
+    return jsonify({"access_token": access_token}), 200
+
+@app.route("/api/logout", methods=["POST"])
+@jwt_required(verify_type=False)
+def logout():
+    # revokes the token it is called with and, if {"refresh_token"} is sent, the refresh token of the same user
+    tokens = [get_jwt()]
+    refresh = (request.get_json(silent=True) or {}).get("refresh_token")
+    if refresh:
+        try:
+            claims = decode_token(refresh)
+        except (JWTExtendedException, PyJWTError):
+            return jsonify({"error": "Invalid refresh token"}), 400
+        if claims["sub"] != get_jwt()["sub"]:
+            return jsonify({"error": "Invalid refresh token"}), 400
+        tokens.append(claims)
+
+    for claims in tokens:
+        stmt = sqlite_insert(RevokedToken).values(jti=claims["jti"], expires=claims["exp"])
+        db.session.execute(stmt.on_conflict_do_nothing(index_elements=["jti"]))
+    db.session.commit()
+    return jsonify({"message": "Logged out successfully"}), 200
 
 #create parking lot using jwt token
 @app.route("/api/parking_lots", methods=["POST"])
@@ -87,12 +137,13 @@ def create_parking_lot():
     parking_lot = ParkingLot(name=name, city=city, location=location, total_spots=total_spots, price=price)
     
     db.session.add(parking_lot)
-    db.session.commit()
+    db.session.flush()
     
-    for i in range(total_spots):
-        parking_spot = ParkingSpot(lot_id=parking_lot.id, status='available')
-        db.session.add(parking_spot)
-        db.session.commit()
+    # insert all spots in one executemany and commit lot + spots together
+    spots = [{"lot_id": parking_lot.id, "status": "available"}] * total_spots
+    if spots:
+        db.session.execute(insert(ParkingSpot), spots)
+    db.session.commit()
     
     return jsonify({"message": "Parking lot created successfully"}), 201
 
@@ -196,6 +247,7 @@ def create_reservation():
             cost=cost
             )
         db.session.add(reservation)
+        reservation_booked(parkingLot.id, reservation)
         db.session.commit()
         
         spot.status = 'reserved'
@@ -243,6 +295,7 @@ def update_reservation(reservation_id):
         reservation.status = 'completed'
         spot = ParkingSpot.query.get(reservation.spot_id)
         spot.status = 'available'
+        reservation_released(spot.lot_id, reservation)
         db.session.commit()
         return jsonify({"message": "Reservation updated successfully"}), 200
     else:
@@ -309,46 +362,51 @@ def export_user_reservations():
 @jwt_required()
 def get_user_summary():
     user_id = get_jwt_identity()
-    reservations = Reservation.query.filter_by(user_id=user_id).all()
-    lot_summary = {}
-    for res in reservations:
-        parking_spot = ParkingSpot.query.get(res.spot_id)
-        parking_lot = ParkingLot.query.get(parking_spot.lot_id)
-        if parking_lot.name not in lot_summary:
-            lot_summary[parking_lot.name] = {
-                "total_reservations": 0,
-                "total_cost": 0.0
-            }
-        lot_summary[parking_lot.name]["total_reservations"] += 1
-        lot_summary[parking_lot.name]["total_cost"] += res.cost
-        
-    lot_names = []
-    lot_counts = []
-    lot_costs = []
-    for lot_name, summary in lot_summary.items():
-        lot_names.append(lot_name)
-        lot_counts.append(summary["total_reservations"])
-        lot_costs.append(summary["total_cost"])
-
-    total_spent = sum(summary["total_cost"] for summary in lot_summary.values())
-    active_reservations = sum(1 for res in reservations if res.status == "active")
-    completed_reservations = sum(1 for res in reservations if res.status == "completed")    
+    lot_names, lot_counts, lot_costs = lot_totals(user_id)
+    statuses = status_counts(user_id)
     
     return jsonify({
         "lot_names": lot_names,
         "lot_counts": lot_counts,
         "lot_costs": lot_costs,
-        "total_spent": total_spent,
-        "active_reservations": active_reservations,
-        "completed_reservations": completed_reservations,
-        "total_reservations": len(reservations)
+        "total_spent": sum(lot_costs),
+        "active_reservations": statuses.get("active", 0),
+        "completed_reservations": statuses.get("completed", 0),
+        "total_reservations": sum(lot_counts)
     })
     
 
+@app.cli.command("prune-revoked-tokens")
+def prune_revoked_tokens_command():
+    # flask --app app prune-revoked-tokens
+    db.create_all()
+    removed = db.session.execute(delete(RevokedToken).where(RevokedToken.expires <= int(time.time()))).rowcount
+    db.session.commit()
+    print(f"{removed} expired revoked tokens removed")
+
+
+@app.cli.command("rebuild-lot-stats")
+def rebuild_lot_stats_command():
+    # flask --app app rebuild-lot-stats
+    db.create_all()
+    rebuild_lot_stats()
+    print("lot_stats rebuilt from reservations")
+
+
+@app.cli.command("create-indexes")
+def create_indexes_command():
+    # flask --app app create-indexes
+    if {"lot_stats", "user_lot_stats"} & create_indexes():
+        rebuild_lot_stats()
+        print("lot_stats built from reservations")
+    print("indexes created")
+
+
 if __name__ == "__main__":
     
     with app.app_context():
-        db.create_all()
+        if {"lot_stats", "user_lot_stats"} & create_indexes():
+            rebuild_lot_stats()  # a database from before the stats tables: fill them from its reservations
         if not User.query.filter_by(username='admin').first():
             admin = User(username="admin", email="admin@gmail.com", password=generate_password_hash("admin123"), role="admin")
             db.session.add(admin)
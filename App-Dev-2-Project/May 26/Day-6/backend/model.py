@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 
 db = SQLAlchemy()
 
@@ -20,7 +21,7 @@ class ParkingLot(db.Model):
     location = db.Column(db.String(200), nullable=False)
     total_spots = db.Column(db.Integer, nullable=False) #4
     price = db.Column(db.Float, nullable=False)
-    is_deleted = db.Column(db.Boolean, default=False, nullable=False)
+    is_deleted = db.Column(db.Boolean, default=False, nullable=False, index=True)
     
     parking_spots = db.relationship('ParkingSpot', backref='parking_lot', lazy=True)
     
@@ -32,13 +33,53 @@ class ParkingSpot(db.Model):
     
     reservations = db.relationship('Reservation', backref='parking_spot', lazy=True)
 
+    __table_args__ = (db.Index('ix_parking_spot_lot_status', 'lot_id', 'status'),)
+
 
 class Reservation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     spot_id = db.Column(db.Integer, db.ForeignKey('parking_spot.id'), nullable=False)
     vehicle_number = db.Column(db.String(20), nullable=False)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), default='active', nullable=False)  # 'active', 'completed', 'cancelled'
-    cost = db.Column(db.Float, nullable=False)
\ No newline at end of file
+    status = db.Column(db.String(20), default='active', nullable=False, index=True)  # 'active', 'completed', 'cancelled'
+    cost = db.Column(db.Float, nullable=False)
+
+# read models for the summary endpoint, kept in step with Reservation by summary.bump_stats
+class LotStats(db.Model):
+    __tablename__ = 'lot_stats'
+    lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    reservations = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    active = db.Column(db.Integer, default=0, nullable=False)
+    completed = db.Column(db.Integer, default=0, nullable=False)
+
+
+class UserLotStats(db.Model):
+    __tablename__ = 'user_lot_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), primary_key=True)
+    reservations = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    active = db.Column(db.Integer, default=0, nullable=False)
+    completed = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RevokedToken(db.Model):
+    # the jti of every token revoked by /api/logout, kept until the token would have expired anyway
+    __tablename__ = 'revoked_token'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires = db.Column(db.Integer, nullable=False, index=True)  # the token's exp, seconds since the epoch
+
+
+def create_indexes():
+    # create_all() skips tables that already exist, so add any missing index to an existing database.
+    # Returns the names of the tables that did not exist yet
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    return set(db.metadata.tables) - existing
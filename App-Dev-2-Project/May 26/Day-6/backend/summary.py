@@ -0,0 +1,77 @@
+from sqlalchemy import func, case, insert, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from model import db, ParkingLot, ParkingSpot, Reservation, LotStats, UserLotStats
+
+COUNTERS = ('reservations', 'revenue', 'active', 'completed')
+
+
+def bump_stats(lot_id, user_id, reservations=0, revenue=0.0, active=0, completed=0):
+    # upsert both read models in the caller's transaction; the caller commits
+    deltas = {'reservations': reservations, 'revenue': revenue, 'active': active, 'completed': completed}
+    for model, keys in (
+        (LotStats, {'lot_id': lot_id}),
+        (UserLotStats, {'user_id': user_id, 'lot_id': lot_id}),
+    ):
+        stmt = sqlite_insert(model).values(**keys, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in COUNTERS}
+        )
+        db.session.execute(stmt)
+
+
+def reservation_booked(lot_id, reservation):
+    bump_stats(lot_id, reservation.user_id, reservations=1, revenue=reservation.cost, active=1)
+
+
+def reservation_released(lot_id, reservation):
+    bump_stats(lot_id, reservation.user_id, active=-1, completed=1)
+
+
+def rebuild_lot_stats():
+    # regenerate both read models from the Reservation table in one transaction
+    db.session.execute(delete(LotStats))
+    db.session.execute(delete(UserLotStats))
+
+    for model, group_by in (
+        (LotStats, [ParkingSpot.lot_id]),
+        (UserLotStats, [Reservation.user_id, ParkingSpot.lot_id]),
+    ):
+        query = db.session.query(
+            *group_by,
+            func.count(Reservation.id),
+            func.sum(Reservation.cost),
+            func.sum(case((Reservation.status == 'active', 1), else_=0)),
+            func.sum(case((Reservation.status == 'completed', 1), else_=0))
+        ).join(ParkingSpot, Reservation.spot_id == ParkingSpot.id).group_by(*group_by)
+        columns = [column.key for column in group_by] + list(COUNTERS)
+        db.session.execute(insert(model).from_select(columns, query.statement))
+
+    db.session.commit()
+
+
+def lot_totals(user_id=None):
+    # reservation count and cost per lot name, read from the stats table (one row per lot)
+    model = LotStats if user_id is None else UserLotStats
+    query = db.session.query(
+        ParkingLot.name,
+        func.sum(model.reservations),
+        func.sum(model.revenue)
+    ).join(ParkingLot, model.lot_id == ParkingLot.id)
+    if user_id is not None:
+        query = query.filter(UserLotStats.user_id == user_id)
+    rows = query.filter(model.reservations > 0).group_by(ParkingLot.name).order_by(func.min(ParkingLot.id)).all()
+
+    lot_names = [row[0] for row in rows]
+    lot_counts = [row[1] for row in rows]
+    lot_costs = [row[2] for row in rows]
+    return lot_names, lot_counts, lot_costs
+
+
+def status_counts(user_id=None):
+    model = LotStats if user_id is None else UserLotStats
+    query = db.session.query(func.sum(model.active), func.sum(model.completed))
+    if user_id is not None:
+        query = query.filter(UserLotStats.user_id == user_id)
+    active, completed = query.one()
+    return {'active': active or 0, 'completed': completed or 0}
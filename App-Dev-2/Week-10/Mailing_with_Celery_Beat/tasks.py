@@ -2,16 +2,18 @@ from celery_worker import celery_app
 from models import User, BookRequest
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import smtplib
 from flask import render_template
+from mailer import SMTPPool
 
 SMTP_HOST = 'localhost'
 SMTP_PORT = 1025
 SENDER_EMAIL = "skp@iitm.in"
 SENDER_PASSWORD = ""
 
+mailer = SMTPPool(SMTP_HOST, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD)
 
-def send_email(to_address, subject, body, content_type="text", attachments=None):
+
+def build_email(to_address, subject, body, content_type="text"):
     msg = MIMEMultipart()
     msg['To'] = to_address
     msg['Subject'] = subject
@@ -21,11 +23,16 @@ def send_email(to_address, subject, body, content_type="text", attachments=None)
         msg.attach(MIMEText(body, 'html'))
     else:
         msg.attach(MIMEText(body, 'plain'))
-    s = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-    s.login(SENDER_EMAIL, SENDER_PASSWORD)
-    s.send_message(msg)
-    s.quit()
-    return True 
+    return msg
+
+
+def send_email(to_address, subject, body, content_type="text"):
+    return mailer.send(build_email(to_address, subject, body, content_type))
+
+
+def send_emails(emails):
+    # emails: (to_address, subject, body) tuples, all sent over one pooled connection
+    return mailer.send_many(build_email(*email) for email in emails)
     
 
 
@@ -45,7 +52,8 @@ def generate_monthly_report():
         book_details.append({'username': username, 'book_name': book_name, 'status': status})
     # print(book_details)    
     html_body = render_template('monthly_report.html', book_details=book_details)   
-    send_email(admin.email, "Monthly Book Request Report", html_body, content_type="html")   
+    if not send_email(admin.email, "Monthly Book Request Report", html_body, content_type="html"):
+        return "Monthly report generated but could not be delivered."
     return "Monthly report generated and sent to admin."
 
 
@@ -54,12 +62,14 @@ def send_daily_reminder():
     user = User.query.all()
     book_requests = BookRequest.query.filter_by(status='pending').all()
     
+    emails = []
     for u in user:
         for req in book_requests:
             if u.id == req.user_id:
                 message = f"Hello {u.username}, you have a pending book request for '{req.book_name}' made on {req.request_date}."
-                send_email(u.email, "Daily Reminder", message)
-    return "done sending daily reminder."
+                emails.append((u.email, "Daily Reminder", message))
+    sent = send_emails(emails)
+    return f"done sending daily reminder: {sent} of {len(emails)} sent."
 
 @celery_app.task
 def generate_user_report(user_id):
@@ -79,7 +89,8 @@ def generate_user_report(user_id):
         rq.append({'username': username, 'book_name': book_name, 'status': status})
     # print(book_details)    
     html_body = render_template('monthly_report.html', book_details=rq)   
-    send_email(user.email, "Monthly Book Request Report", html_body, content_type="html")   
+    if not send_email(user.email, "Monthly Book Request Report", html_body, content_type="html"):
+        return f"Report generated for user {user.username} but could not be delivered"
      
         
     return f"Report generated for user {user.username} with {len(req)} book requests"    
\ No newline at end of file
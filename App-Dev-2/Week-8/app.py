@@ -1,6 +1,11 @@
 from flask import Flask, request, jsonify
 from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required, get_jwt, current_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import OrderedDict, namedtuple
+import threading
+import time
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = "your-secret-key"  # Change this in production!
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///users.db"
@@ -16,14 +21,69 @@ class User(db.Model):
     password = db.Column(db.String(120), nullable=False)
     role = db.Column(db.String(20), nullable=False, default="user")
 
+class RevokedToken(db.Model):
+    # the jti of every token revoked by /logout, kept until the token would have expired anyway
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires = db.Column(db.Integer, nullable=False, index=True)  # the token's exp, seconds since the epoch
+
 @jwt.user_identity_loader
 def load(user):
     return user.username
 
+# current_user is an immutable copy of the row rather than the ORM object, so it can be kept
+# between requests and shared by threads without going back to the database
+UserSnapshot = namedtuple("UserSnapshot", ["id", "username", "role"])
+
+class UserCache:
+    # username -> UserSnapshot, least recently used dropped past maxsize. Entries expire after ttl seconds
+    # so changes made outside this process show up eventually; changes made here call invalidate()
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # username -> (snapshot, expires at)
+
+    def get(self, username):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[username]
+                return None
+            self.entries.move_to_end(username)
+            return entry[0]
+
+    def put(self, snapshot):
+        with self.lock:
+            self.entries[snapshot.username] = (snapshot, time.monotonic() + self.ttl)
+            self.entries.move_to_end(snapshot.username)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+user_cache = UserCache()
+
 @jwt.user_lookup_loader
 def user_lookup(jwt_header, jwt_data):
     identity = jwt_data["sub"]
-    return User.query.filter_by(username=identity).one_or_none()
+    snapshot = user_cache.get(identity)
+    if snapshot is None:
+        user = User.query.filter_by(username=identity).one_or_none()
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user.id, user.username, user.role)
+        user_cache.put(snapshot)
+    return snapshot
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_data):
+    # one lookup on the unique jti index per protected request
+    return db.session.query(RevokedToken.id).filter_by(jti=jwt_data["jti"]).first() is not None
 
 @app.route("/register", methods=["POST"])
 def register():
@@ -49,17 +109,26 @@ def login():
     access_token = create_access_token(identity=user) # if we want to use current_user then we have to give object to the identity
     return jsonify(access_token=access_token), 200
 
+@app.route("/logout", methods=["POST"])
+@jwt_required()
+def logout():
+    # the token stops working straight away, in every process, although it has not expired
+    claims = get_jwt()
+    stmt = sqlite_insert(RevokedToken).values(jti=claims["jti"], expires=claims["exp"]).on_conflict_do_nothing(index_elements=["jti"])
+    db.session.execute(stmt)
+    db.session.commit()
+    return jsonify({"msg": "Logged out successfully"}), 200
+
 @app.route("/dashboard", methods=["GET"])
 @jwt_required()
 def dashboard():
-    current_user = get_jwt_identity()
     claims = get_jwt()
     role = claims.get("role", "user")
     
     roles = get_jwt().get("role")
-    current_user = current_user.id
+    current_user_id = current_user.id
     
-    return jsonify(logged_in_as=current_user, role=role, roles = roles), 200
+    return jsonify(logged_in_as=current_user_id, role=role, roles = roles), 200
 @app.route("/check_user", methods=["GET"]) # this will work for current_user
 @jwt_required()
 def check_current_user():
@@ -75,6 +144,31 @@ def admin():
         return jsonify({"msg": "Admins only!"}), 403
     return jsonify({"msg": "Welcome, admin!"}), 200
 
+@app.route("/users/<username>/role", methods=["PUT"])
+@jwt_required()
+def change_role(username):
+    if current_user.role != "admin":
+        return jsonify({"msg": "Admins only!"}), 403
+    user = User.query.filter_by(username=username).one_or_none()
+    if not user:
+        return jsonify({"msg": "User not found"}), 404
+    data = request.get_json(silent=True)
+    role = data.get("role") if isinstance(data, dict) else None
+    if role not in ("user", "admin"):
+        return jsonify({"msg": 'role must be "user" or "admin"'}), 400
+    user.role = role
+    db.session.commit()
+    user_cache.invalidate(username)  # the user's next request sees the new role
+    return jsonify({"msg": "Role updated"}), 200
+
+@app.cli.command("prune-revoked-tokens")
+def prune_revoked_tokens_command():
+    # flask --app app prune-revoked-tokens
+    # the rows of expired tokens are no longer needed, the tokens are refused anyway
+    removed = db.session.execute(delete(RevokedToken).where(RevokedToken.expires <= int(time.time()))).rowcount
+    db.session.commit()
+    print(f"{removed} expired revoked tokens removed")
+
 
 if __name__ == "__main__":
     with app.app_context():
@@ -1,6 +1,9 @@
 from flask import Flask, request, jsonify
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
-from models import db, User, BookRequest
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, User, BookRequest, RevokedToken
+import time
 
 
 
@@ -13,6 +16,11 @@ jwt = JWTManager(app)
 
 with app.app_context():
     db.create_all()
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    # one lookup on the unique jti index per protected request
+    return db.session.query(RevokedToken.id).filter_by(jti=jwt_payload['jti']).first() is not None
     
 @app.route('/register', methods=['POST'])
 def register():
@@ -35,6 +43,15 @@ def login():
     token = create_access_token(identity=user.id, additional_claims={'role': user.role})
     return jsonify({'access_token': token}), 200  
 
+@app.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    claims = get_jwt()
+    stmt = sqlite_insert(RevokedToken).values(jti=claims['jti'], expires=claims['exp']).on_conflict_do_nothing(index_elements=['jti'])
+    db.session.execute(stmt)
+    db.session.commit()
+    return jsonify({'msg': 'Logged out successfully'}), 200
+
 @app.route('/request-book', methods=['POST'])
 @jwt_required()
 def request_book():
@@ -62,5 +79,13 @@ def export_report():
 
 
 
+@app.cli.command('prune-revoked-tokens')
+def prune_revoked_tokens_command():
+    # flask --app app prune-revoked-tokens
+    # the rows of expired tokens are no longer needed, the tokens are refused anyway
+    removed = db.session.execute(delete(RevokedToken).where(RevokedToken.expires <= int(time.time()))).rowcount
+    db.session.commit()
+    print(f'{removed} expired revoked tokens removed')
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -16,4 +16,10 @@ class BookRequest(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     book_name = db.Column(db.String(200), nullable=False)
     status = db.Column(db.String(20), default='pending')  # 'pending', 'approved', 'returned'
-    request_date = db.Column(db.DateTime, server_default=db.func.now())
\ No newline at end of file
+    request_date = db.Column(db.DateTime, server_default=db.func.now())
+
+class RevokedToken(db.Model):
+    # the jti of every token revoked by /logout, kept until the token would have expired anyway
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires = db.Column(db.Integer, nullable=False, index=True)  # the token's exp, seconds since the epoch